@@ -0,0 +1,373 @@
+"""Benchmarks of the PyXel hot paths.
+
+Times region extraction (distribute_pixels, merge_bins, get_bin_vals,
+profile), the C-statistic and its derivatives, the surface brightness
+models, and MCMC sampling, and measures the peak memory of each benchmark
+with tracemalloc. The extraction benchmarks use the Chandra stacks and
+regions in examples/data, and synthetic images of several sizes, which are
+written to a temporary directory. Everything runs offline.
+
+Run from the repository root:
+
+    python benchmarks/run_benchmarks.py
+
+The results are written to benchmarks/results.json, and compared with
+benchmarks/baseline.json if it exists; the command exits with status 1 if a
+benchmark is slower than the baseline by more than the tolerance. Use
+--save-baseline to store the results as the new baseline. Baselines are
+only comparable on the same machine.
+"""
+import argparse
+import contextlib
+import datetime
+import glob
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+from astropy.io import fits
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DATA_DIR = os.path.join(REPO_DIR, 'examples', 'data')
+sys.path.insert(0, REPO_DIR)
+
+import pyxel
+from pyxel import models, projection, stats
+from pyxel.cache import ProfileCache, label_cache
+
+DEFAULT_SIZES = (256, 1024, 4096)
+QUICK_SIZES = (256, 1024)
+
+# distribute_pixels and get_bin_vals work on Python lists of pixels, which
+# take too much memory for regions in larger images.
+MAX_PIXEL_LIST_SIZE = 1024
+
+# Parameters of the broken power-law fit to the NE profile of ZwCl 2341.
+BKNPOW_PARAMS = dict(ind1=0., ind2=1.2, norm=3.5e-5, rbreak=1.36, jump=2.5,
+                     const=5.45e-7)
+BETA_PARAMS = dict(s0=1e-4, beta=0.7, rc=0.5, const=5e-7)
+
+def example_images():
+    """Open the example Chandra stacks."""
+    counts = sorted(glob.glob(os.path.join(DATA_DIR,
+                                           'srcfree*_thresh.img')))
+    bkg = sorted(glob.glob(os.path.join(DATA_DIR, '*bgstow_goodreg.img')))
+    exp = sorted(glob.glob(os.path.join(DATA_DIR,
+                                        'srcfree*expmap_nosrcedg')))
+    return pyxel.Image(counts), pyxel.Image(bkg), pyxel.Image(exp)
+
+def make_synthetic_images(size, out_dir, seed=0):
+    """Write a counts, background, and exposure map of size x size pixels.
+
+    The counts follow a beta model centered on the image on top of a flat
+    background, with Poisson noise. Returns the three images.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.indices((size, size), dtype=np.float32)
+    r = np.hypot(x - size / 2., y - size / 2.) / (size / 16.)
+    exp = np.full((size, size), 1e5, dtype=np.float32)
+    counts = rng.poisson(5e-5 * exp * ((1. + r**2)**-2. + 0.05))
+    bkg = rng.poisson(5e-5 * exp * 0.05, size=(size, size))
+
+    hdr = fits.Header()
+    hdr['EXPOSURE'] = 1e5
+    hdr['CDELT1'] = -0.000136667
+    hdr['CDELT2'] = 0.000136667
+    filenames = []
+    for name, data in (('counts', counts.astype(np.float32)),
+                       ('bkg', bkg.astype(np.float32)), ('exp', exp)):
+        filename = os.path.join(out_dir, '%s_%d.fits' % (name, size))
+        fits.writeto(filename, data, hdr, overwrite=True)
+        filenames.append(filename)
+    return [pyxel.Image(filename) for filename in filenames]
+
+def region_benchmarks(name, region, imgs, min_counts, islog,
+                      pixel_lists=True):
+    """Benchmarks of the extraction steps for one region."""
+    counts_img, bkg_img, exp_img = imgs
+    length, width = counts_img.shape
+    edges = region.make_edges(islog)
+    bkg_full, exp_full = pyxel.utils.get_bkg_exp(counts_img, bkg_img,
+                                                 exp_img)
+    rows, cols, _ = region.assign_pixels(edges, length, width)
+    pixels = list(zip(rows.tolist(), cols.tolist())) if pixel_lists else []
+
+    def merge_bins():
+        label_cache.clear()
+        region.merge_bins(counts_img, bkg_img, exp_img, min_counts, islog)
+
+    def profile():
+        label_cache.clear()
+        region.profile(counts_img, bkg_img, exp_img, min_counts, islog)
+
+    benchmarks = [(name + '.merge_bins', merge_bins),
+                  (name + '.profile', profile)]
+    if pixel_lists:
+        benchmarks += [
+            (name + '.distribute_pixels',
+             lambda: region.distribute_pixels(edges, length, width)),
+            (name + '.get_bin_vals',
+             lambda: region.get_bin_vals(counts_img, bkg_full, exp_full,
+                                         pixels)),
+        ]
+    return benchmarks
+
+def extraction_benchmarks(sizes, tmp_dir):
+    benchmarks = []
+    imgs = example_images()
+    # The first (warm-up) run fills the cache, so the timed runs are hits,
+    # to compare with the profile benchmarks without the cache.
+    cache = ProfileCache(os.path.join(tmp_dir, 'profiles'))
+    for reg_name in ('ne', 'skybkg'):
+        region = pyxel.load_region(os.path.join(DATA_DIR,
+                                                reg_name + '.reg'))
+        benchmarks += region_benchmarks('example.' + reg_name, region, imgs,
+                                        min_counts=25, islog=False)
+        benchmarks.append(
+            ('example.%s.profile_cache_hit' % reg_name,
+             lambda region=region: region.profile(*imgs, min_counts=25,
+                                                  islog=False, cache=cache)))
+    for size in sizes:
+        imgs = make_synthetic_images(size, tmp_dir)
+        center = size / 2. - 0.5
+        annulus = pyxel.Epanda(center, center, 0., 2 * np.pi,
+                               0.45 * size, 0.45 * size, 0.)
+        box = pyxel.Box(center, center, size / 8., 0.8 * size, 0.3)
+        pixel_lists = size <= MAX_PIXEL_LIST_SIZE
+        benchmarks += region_benchmarks('synthetic_%d.annulus' % size,
+                                        annulus, imgs, min_counts=100,
+                                        islog=True, pixel_lists=pixel_lists)
+        benchmarks += region_benchmarks('synthetic_%d.box' % size, box, imgs,
+                                        min_counts=100, islog=True,
+                                        pixel_lists=pixel_lists)
+    return benchmarks
+
+def fit_data(model, nbins=200, seed=0):
+    """Simulate a binned profile from a model.
+
+    The exposures are long enough for every bin to have counts, like the
+    bins of profiles grouped to a minimum number of counts; the C-statistic
+    is not defined for bins without source and background counts.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.logspace(-1, 0.7, nbins)
+    x_err = np.gradient(x) / 2.
+    t_raw = np.full(nbins, 2e7)
+    t_bkg = np.full(nbins, 4e7)
+    raw_cts = rng.poisson(model(x) * t_raw).astype(float)
+    bkg_cts = rng.poisson(5e-7 * t_bkg).astype(float)
+    return x, x_err, raw_cts, bkg_cts, t_raw, t_bkg
+
+def model_benchmarks():
+    bknpow = models.BrokenPow(**BKNPOW_PARAMS)
+    beta = models.Beta(**BETA_PARAMS)
+    x, x_err, raw_cts, bkg_cts, t_raw, t_bkg = fit_data(bknpow)
+    int_bknpow = models.IntModel(bknpow, x_err)
+    params = bknpow.parameters
+    return [
+        ('stats.cstat',
+         lambda: stats.cstat(raw_cts, bknpow, bkg_cts, t_raw, t_bkg, x)),
+        ('stats.cstat_deriv',
+         lambda: stats.cstat_deriv(raw_cts, bknpow, bkg_cts, t_raw, t_bkg,
+                                   x)),
+        ('models.BrokenPow.evaluate',
+         lambda: models.BrokenPow.evaluate(x, *params)),
+        ('models.Beta.evaluate',
+         lambda: models.Beta.evaluate(x, *beta.parameters)),
+        ('models.IntModel.BrokenPow', lambda: int_bknpow(x)),
+        ('models.BrokenPow.evaluate_with_derivatives',
+         lambda: models.BrokenPow.evaluate_with_derivatives(x, *params)),
+    ] + projection_benchmarks(x, params)
+
+def projection_benchmarks(x, params):
+    """BrokenPow with the interpolation tables, to compare with the
+    closed form. The tables are generated in ~/.pyxel the first time."""
+    table = projection.enable_projection_table()
+    projection.disable_projection_table()
+    x_err = np.gradient(x) / 2.
+    int_bknpow = models.IntModel(models.BrokenPow(*params), x_err)
+
+    def with_table(func):
+        def run():
+            projection.set_projection_table(table)
+            try:
+                func()
+            finally:
+                projection.set_projection_table(None)
+        return run
+
+    return [
+        ('models.BrokenPow.evaluate_with_derivatives.table',
+         with_table(lambda: models.BrokenPow.evaluate_with_derivatives(
+             x, *params))),
+        ('models.IntModel.BrokenPow.table', with_table(lambda: int_bknpow(x))),
+    ]
+
+def mcmc_benchmarks():
+    """MCMC benchmarks, timed per sampler step with 100 walkers."""
+    try:
+        from pyxel.fitters import CstatFitter
+    except ImportError as err:
+        return [('mcmc.' + name, err) for name in ('BrokenPow.step',
+                                                   'Beta.step')]
+
+    def step(model_cls, params, nsteps=5):
+        model = model_cls(**params)
+        x, _, raw_cts, bkg_cts, t_raw, t_bkg = fit_data(model)
+        fitter = CstatFitter()
+
+        def run():
+            # mcmc_err prints a summary of the fit.
+            with contextlib.redirect_stdout(io.StringIO()):
+                fitter.mcmc_err(model, x, raw_cts, bkg_cts, t_raw, t_bkg,
+                                nruns=nsteps + 1, nburn=1, nwalkers=100,
+                                with_corner=False, workers=1)
+        return run, nsteps
+
+    return [('mcmc.BrokenPow.step', step(models.BrokenPow, BKNPOW_PARAMS)),
+            ('mcmc.Beta.step', step(models.Beta, BETA_PARAMS))]
+
+def measure(func, repeat, per_call=1):
+    """Time a benchmark and measure its peak memory.
+
+    The benchmark is run once to warm up, then `repeat` times; the minimum
+    and median wall times are reported, divided by `per_call`. The peak
+    memory allocated during one more run is measured separately, because
+    tracemalloc slows the code down.
+    """
+    func()
+    times = np.array(timeit.repeat(func, number=1, repeat=repeat)) / per_call
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'status': 'ok', 'time_min': float(times.min()),
+            'time_median': float(np.median(times)), 'repeat': repeat,
+            'peak_memory': int(peak)}
+
+def run_benchmarks(sizes, repeat, name_filter=None):
+    tmp_dir = tempfile.mkdtemp(prefix='pyxel_bench_')
+    results = {}
+    try:
+        benchmarks = extraction_benchmarks(sizes, tmp_dir) + \
+            model_benchmarks() + mcmc_benchmarks()
+        for name, bench in benchmarks:
+            if name_filter is not None and name_filter not in name:
+                continue
+            if isinstance(bench, Exception):
+                results[name] = {'status': 'skipped',
+                                 'reason': '%s: %s' %
+                                           (bench.__class__.__name__, bench)}
+            else:
+                func, per_call = bench if isinstance(bench, tuple) \
+                    else (bench, 1)
+                # Benchmarks on large images are slow, so they are repeated
+                # fewer times.
+                nrepeat = repeat if 'synthetic_4096' not in name \
+                    else max(1, repeat // 5)
+                results[name] = measure(func, nrepeat, per_call)
+            print(format_result(name, results[name]))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+def metadata():
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+def format_result(name, result):
+    if result['status'] != 'ok':
+        return '%-45s %s (%s)' % (name, result['status'], result['reason'])
+    return '%-45s %10.3f ms %10.1f MiB' % (name, result['time_min'] * 1e3,
+                                          result['peak_memory'] / 2.**20)
+
+def compare(results, baseline, tolerance):
+    """Compare the minimum times with the baseline. Returns the names of
+    the benchmarks that are slower by more than the tolerance."""
+    regressions = []
+    print('\n%-45s %12s %12s %8s' % ('Benchmark', 'Baseline', 'Current',
+                                     'Ratio'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if result['status'] != 'ok' or base is None or \
+                base['status'] != 'ok':
+            continue
+        ratio = result['time_min'] / base['time_min']
+        flag = ''
+        if ratio > 1. + tolerance:
+            regressions.append(name)
+            flag = ' SLOWER'
+        elif ratio < 1. / (1. + tolerance):
+            flag = ' faster'
+        print('%-45s %9.3f ms %9.3f ms %8.2f%s' %
+              (name, base['time_min'] * 1e3, result['time_min'] * 1e3,
+               ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the PyXel benchmarks.')
+    parser.add_argument('-o', '--output',
+                        default=os.path.join(BENCH_DIR, 'results.json'),
+                        help='results file (default: %(default)s)')
+    parser.add_argument('-b', '--baseline',
+                        default=os.path.join(BENCH_DIR, 'baseline.json'),
+                        help='baseline to compare with (default: '
+                             '%(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None,
+                        help='sizes of the synthetic images (default: %s)' %
+                             ' '.join(str(size) for size in DEFAULT_SIZES))
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the largest synthetic images')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of timed runs (default: %(default)s)')
+    parser.add_argument('-k', '--filter', default=None,
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown (default: '
+                             '%(default)s)')
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    start = time.time()
+    results = run_benchmarks(sizes, args.repeat, args.filter)
+    output = {'metadata': metadata(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print('\nResults written to %s (%.0f s).' % (args.output,
+                                                  time.time() - start))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Baseline written to %s.' % args.baseline)
+        return 0
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('\n%d benchmarks are slower than the baseline.' %
+                  len(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
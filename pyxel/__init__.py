@@ -1,4 +1,8 @@
 from .box import Box
-from .epanda import Epanda
+from .cache import ProfileCache
+from .epanda import Epanda, EllipticalGrid
 from .image import Image
-from .load_data import load_region
+from .load_data import load_region, load_regions
+from .prof import profiles
+from .sweep import sector_profiles, sweep_angles
+from .table import ProfileTable
@@ -0,0 +1,281 @@
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from .table import ProfileTable
+
+# Version of the cached profile format. Entries saved with a different
+# version are not found, and are eventually evicted.
+PROFILE_CACHE_VERSION = 1
+
+DEFAULT_PROFILE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pyxel',
+                                         'profiles')
+
+_file_checksums = {}
+
+def hash_key(key):
+    """Hash a cache key into a string that can be used as a file name."""
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def save_npz(filename, **arrays):
+    """Save arrays to an .npz file atomically.
+
+    The arrays are first written to a temporary file in the same directory,
+    which is then renamed, so concurrent readers never see partial files.
+    """
+    dirname = os.path.dirname(filename)
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+class LabelCache(object):
+    """Bounded LRU cache of region label maps.
+
+    Each entry holds the pixels of a region in compact form: the flat
+    (row * width + col) index of each pixel and the index of the bin it
+    belongs to, both as int32 arrays. The least recently used entries are
+    dropped when the arrays in memory take more than `max_bytes`, since the
+    entries of large regions are large (8 bytes per pixel); `max_bytes=0`
+    disables the cache. If `cache_dir` is set, entries are also saved there
+    as .npz files, and entries missing from memory are looked up on disk
+    before the label map is recomputed.
+    """
+    def __init__(self, max_bytes=256 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, 'labels-%s.npz' % hash_key(key))
+
+    def get(self, key):
+        """Return the (flat index, bin) arrays stored under key, or None."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        if self.cache_dir is not None and os.path.isfile(self._filename(key)):
+            with np.load(self._filename(key)) as f:
+                entry = (f['flat'], f['bins'])
+            self._store(key, entry)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, flat, bins):
+        """Store the flat pixel indices and bins of a region under key."""
+        entry = (np.asarray(flat, dtype=np.int32),
+                 np.asarray(bins, dtype=np.int32))
+        self._store(key, entry)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            save_npz(self._filename(key), flat=entry[0], bins=entry[1])
+
+    def _store(self, key, entry):
+        nbytes = sum(arr.nbytes for arr in entry)
+        if nbytes > self.max_bytes:
+            return
+        for arr in entry:
+            arr.flags.writeable = False
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= sum(arr.nbytes for arr in old)
+        self._entries[key] = entry
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self.nbytes -= sum(arr.nbytes for arr in old)
+
+    def clear(self):
+        """Remove all entries from memory. Files on disk are kept."""
+        self._entries.clear()
+        self.nbytes = 0
+
+label_cache = LabelCache()
+
+def array_checksum(arr):
+    """Checksum of the shape, type, and contents of an array."""
+    arr = np.ascontiguousarray(arr)
+    sha = hashlib.sha1(repr((arr.dtype.str, arr.shape)).encode('utf-8'))
+    sha.update(arr.view(np.uint8).ravel() if arr.size else b'')
+    return sha.hexdigest()
+
+def file_checksum(filename):
+    """Checksum of the contents of a file.
+
+    Checksums are remembered for the lifetime of the process, and computed
+    again only if the size or modification time of the file changes.
+    """
+    filename = os.path.realpath(filename)
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime_ns)
+    if key not in _file_checksums:
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                sha.update(block)
+        _file_checksums[key] = sha.hexdigest()
+    return _file_checksums[key]
+
+def header_checksum(hdr):
+    """Checksum of the cards of a FITS header."""
+    return hash_key(''.join(card.image for card in hdr.cards))
+
+def image_fingerprint(img):
+    """Describe the contents of a map, or a list of maps, for a cache key.
+
+    Images are described by checksums of their headers and of their data.
+    The data of memory-mapped images are described by the checksums of
+    their files, which are looked up at every call, and only computed again
+    when the size or modification time of a file changes. The data of other images
+    might have been changed after the files were read, so they are
+    checksummed directly; this takes longer than a cached profile saves, so
+    the checksums are kept on the Image, and computed again only when its
+    data are replaced or after Image.reset_fingerprint(). Arrays are
+    checksummed every time.
+    """
+    if img is None:
+        return None
+    elif isinstance(img, list):
+        return tuple(image_fingerprint(i) for i in img)
+    elif isinstance(img, np.ndarray):
+        return ('array', array_checksum(img))
+    hdrs = img.hdr if isinstance(img.hdr, list) else [img.hdr]
+    hdr_checksums = tuple(header_checksum(hdr) for hdr in hdrs)
+    if img.memmap:
+        filenames = img.filename if isinstance(img.filename, list) \
+            else [img.filename]
+        exts = img.ext if isinstance(img.ext, list) else [img.ext]
+        data = tuple((file_checksum(fn), ext)
+                     for fn, ext in zip(filenames, exts))
+    else:
+        data = getattr(img, '_data_checksums', None)
+        if data is None:
+            arrays = img.data if isinstance(img.data, list) else [img.data]
+            data = tuple(array_checksum(arr) for arr in arrays)
+            img._data_checksums = data
+    return ('image', hdr_checksums, data)
+
+class ProfileCache(object):
+    """Size-limited on-disk cache of extracted profiles.
+
+    Entries are addressed by the contents of the source, background, and
+    exposure maps (see image_fingerprint), the region geometry, min_counts,
+    and islog, so they stay valid across sessions and processes. Modified
+    headers and memory-mapped files are detected at every lookup, but the
+    data of images read into memory are only checksummed once: after
+    modifying them in place, call Image.reset_fingerprint(), or the old
+    profile is returned. Each entry is an .npz file in `cache_dir` that holds the
+    profile and the bin of each pixel, as the flat (row * width + col)
+    indices of the pixels and their profile bin indices.
+
+    Files are written atomically, so several processes can share a cache
+    directory. When the files take more than `max_bytes`, the least
+    recently used ones are removed.
+    """
+    def __init__(self, cache_dir=None, max_bytes=256 * 2**20):
+        if cache_dir is None:
+            cache_dir = DEFAULT_PROFILE_CACHE_DIR
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, region, counts_img, bkg_img, exp_img, min_counts,
+                islog):
+        """Return the key of the profile of a region."""
+        return (PROFILE_CACHE_VERSION, region.get_key(),
+                float(min_counts), bool(islog),
+                image_fingerprint(counts_img), image_fingerprint(bkg_img),
+                image_fingerprint(exp_img))
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, 'profile-%s.npz' % hash_key(key))
+
+    def get(self, key):
+        """Return the (profile, flat index, bin) stored under key, or
+        None."""
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as f:
+                entry = (ProfileTable(f['profile']), f['flat'], f['bins'])
+            # The modification time marks the last use, for the eviction.
+            os.utime(filename)
+        except (OSError, ValueError, KeyError):
+            # Missing, or removed by another process in the meantime.
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, profile, flat, bins):
+        """Store a profile and the bins of its pixels under key."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        save_npz(self._filename(key), profile=profile.data,
+                 flat=np.asarray(flat, dtype=np.int32),
+                 bins=np.asarray(bins, dtype=np.int32))
+        self.evict()
+
+    def _entries(self):
+        """Return (last use, size, filename) of the files in the cache."""
+        entries = []
+        try:
+            filenames = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return entries
+        for name in filenames:
+            if not (name.startswith('profile-') and name.endswith('.npz')):
+                continue
+            filename = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used files until the cache takes at
+        most max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all the files from the cache."""
+        for _, _, filename in self._entries():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+profile_cache = ProfileCache()
+
+def get_profile_cache(cache):
+    """Return the profile cache to use for the `cache` argument of
+    Region.profile: None or False for no cache, True for the default cache,
+    or a ProfileCache."""
+    if cache is None or cache is False:
+        return None
+    elif cache is True:
+        return profile_cache
+    return cache
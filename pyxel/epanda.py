@@ -4,8 +4,193 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.path import Path
 
-from .utils import rotate_point, get_edges
+from .utils import (rotate_point, get_edges, read_obs_data, get_pix2arcmin,
+                    get_pixel_values, sum_pixel_values)
 from .prof import Region
+from .instrument import stage
+
+def elliptical_coords(x0, y0, major_axis, minor_axis, rot_angle, bounds):
+    """Calculate the polar angles and elliptical radii of a section of pixels.
+
+    bounds = (row_min, row_max, col_min, col_max) is the section of the
+    image. The polar angle is in [0, 2*pi), measured counter-clockwise from
+    the major axis of the ellipse, and is NaN for a pixel at the origin. The
+    elliptical radius is the semi-major axis of the ellipse that passes
+    through the pixel. Returns the row, column, angle, and radius arrays of
+    all the pixels in the section, ordered column by column.
+    """
+    y_min_bound, y_max_bound, x_min_bound, x_max_bound = bounds
+    x, y = np.meshgrid(np.arange(x_min_bound, x_max_bound),
+                       np.arange(y_min_bound, y_max_bound),
+                       indexing='ij')
+    x, y = x.ravel(), y.ravel()
+
+    x_rot_back, y_rot_back = rotate_point(x0, y0, x - x0, y - y0, -rot_angle)
+    x_rel = x_rot_back - x0
+    y_rel = y_rot_back - y0
+
+    right = x_rel >= 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.sqrt(x_rel**2 + y_rel**2)
+        xy_angle = np.where(right, np.arcsin(y_rel / r),
+                            np.arctan(y_rel / x_rel) + np.pi)
+    xy_angle[right & (r < 1e-10)] = np.nan
+    xy_angle[right & (xy_angle < 0)] += 2 * np.pi
+
+    ell_r = np.sqrt(x_rel**2 + y_rel**2 * major_axis**2 / minor_axis**2)
+    return y, x, xy_angle, ell_r
+
+def get_square_bounds(x0, y0, radius, length, width):
+    """Get the pixel ranges of the square with half-side `radius` around
+    (x0, y0).
+
+    Returns (row_min, row_max, col_min, col_max), with the maximum values
+    excluded, clipped to an image with the given length and width.
+    """
+    x_min_bound = max(0, floor(x0 - radius))
+    x_max_bound = min(floor(x0 + radius) + 1, width)
+    y_min_bound = max(0, ceil(y0 - radius))
+    y_max_bound = min(ceil(y0 + radius) + 1, length)
+    return y_min_bound, y_max_bound, x_min_bound, x_max_bound
+
+class EllipticalGrid(object):
+    """Polar angles and elliptical radii of the pixels around an origin.
+
+    The angles and radii depend only on the origin, the axes, and the
+    rotation angle (defined as for Epanda), so they are calculated once for
+    all the pixels within max_radius (default: the major axis) of the
+    origin in an image with the given shape. Pixels can then be assigned to
+    any set of annuli and any sector with a sorted search, without
+    recalculating the coordinates.
+
+    After load_data, the pixel values of the observations are also kept, so
+    profiles with different edges, sectors, or minimum counts only need a
+    bincount over the stored values.
+    """
+    def __init__(self, x0, y0, major_axis, minor_axis, rot_angle, shape,
+                 max_radius=None):
+        self.x0 = x0
+        self.y0 = y0
+        self.major_axis = major_axis
+        self.minor_axis = minor_axis
+        self.rot_angle = rot_angle
+        self.shape = tuple(shape)
+        self.max_radius = major_axis if max_radius is None else max_radius
+        self.bounds = get_square_bounds(x0, y0, self.max_radius, *self.shape)
+        self.rows, self.cols, self.angle, self.radius = elliptical_coords(
+            x0, y0, major_axis, minor_axis, rot_angle, self.bounds)
+        self.at_origin = np.isnan(self.angle)
+        self.values = None
+        self.pix2arcmin = None
+
+    @classmethod
+    def from_region(cls, region, shape, max_radius=None):
+        """Make the grid of an Epanda region in an image with the given
+        shape."""
+        return cls(region.x0, region.y0, region.major_axis,
+                   region.minor_axis, region.rot_angle, shape, max_radius)
+
+    def get_region(self, start_angle=0., end_angle=2 * np.pi):
+        """Return the Epanda sector of the grid between the given angles."""
+        return Epanda(self.x0, self.y0, start_angle, end_angle,
+                      self.major_axis, self.minor_axis, self.rot_angle)
+
+    def make_edges(self, islog=True):
+        return get_edges(self.max_radius, islog)
+
+    def select(self, start_angle=0., end_angle=2 * np.pi):
+        """Return the indices of the grid pixels between the given polar
+        angles (in radians). The pixel at the origin is in every sector."""
+        return np.nonzero(((start_angle <= self.angle) &
+                           (self.angle <= end_angle)) | self.at_origin)[0]
+
+    def get_annuli(self, edges, pixels):
+        """Assign grid pixels to annuli.
+
+        The innermost annulus extends out to edges[2], so annulus i holds the
+        pixels with edges[i+1] <= radius < edges[i+2]. Returns the indices of
+        the pixels inside the annuli and their annulus indices.
+        """
+        bins = np.searchsorted(np.asarray(edges[2:]), self.radius[pixels],
+                               side='right')
+        inside = bins < len(edges) - 2
+        return pixels[inside], bins[inside]
+
+    def assign_pixels(self, edges, start_angle=0., end_angle=2 * np.pi):
+        """Return the row, column, and annulus index of the pixels in the
+        sector between the given angles, as for Epanda.assign_pixels."""
+        pixels, bins = self.get_annuli(edges,
+                                       self.select(start_angle, end_angle))
+        return self.rows[pixels], self.cols[pixels], bins
+
+    def load_data(self, counts_img, bkg_img, exp_img):
+        """Read and store the values of the grid pixels in the source,
+        background, and exposure maps. Only the bounding square of the grid
+        is read."""
+        if tuple(counts_img.shape) != self.shape:
+            raise ValueError('The images have shape %s, but the grid was '
+                             'made for shape %s.' % (tuple(counts_img.shape),
+                                                     self.shape))
+        obs_data = read_obs_data(counts_img, bkg_img, exp_img, self.bounds)
+        self.values = get_pixel_values(obs_data,
+                                       self.rows - self.bounds[0],
+                                       self.cols - self.bounds[2])
+        self.pix2arcmin = get_pix2arcmin(counts_img)
+
+    def bin_sums(self, edges, sectors):
+        """Sum the stored pixel values in the annuli of several sectors.
+
+        `sectors` is a list of (start angle, end angle) tuples. The sums of
+        all the sectors are calculated at once, with combined (sector,
+        annulus) labels. Returns one tuple of sums per sector, as returned
+        by get_bin_sums.
+        """
+        if self.values is None:
+            raise ValueError('No data loaded; call load_data first.')
+        nbins = len(edges) - 1
+        # A pixel on the boundary of two sectors belongs to both of them, so
+        # the pixels of each sector are gathered separately.
+        sector_pixels, sector_labels = [], []
+        for i, (start_angle, end_angle) in enumerate(sectors):
+            pixels, bins = self.get_annuli(edges,
+                                           self.select(start_angle,
+                                                       end_angle))
+            sector_pixels.append(pixels)
+            sector_labels.append(i * nbins + bins)
+        pixels = np.concatenate(sector_pixels)
+        with stage('grid.bin_sums', pixels=len(pixels) * len(self.values[0])):
+            sums = sum_pixel_values(self.values,
+                                    np.concatenate(sector_labels),
+                                    len(sectors) * nbins, pixels)
+        sums = [vals.reshape(len(sectors), nbins) for vals in sums]
+        return [tuple(vals[i] for vals in sums) for i in range(len(sectors))]
+
+    def sector_profiles(self, sectors, min_counts=50, islog=True, edges=None):
+        """Generate the count profiles of several sectors from the stored
+        data.
+
+        `edges` are the edges of the initial (fine) annuli, which default to
+        those of an Epanda with the major axis of the grid. Each sector is
+        grouped separately, so the profiles are the same as those of the
+        corresponding Epanda regions. Returns a list of ProfileTables.
+        """
+        if edges is None:
+            edges = self.make_edges(islog)
+        tables = []
+        for (start_angle, end_angle), sums in zip(sectors,
+                                                  self.bin_sums(edges,
+                                                                sectors)):
+            region = self.get_region(start_angle, end_angle)
+            tables.append(region.profile_from_sums(edges, sums, min_counts,
+                                                   self.pix2arcmin))
+        return tables
+
+    def profile(self, start_angle=0., end_angle=2 * np.pi, min_counts=50,
+                islog=True, edges=None):
+        """Generate the count profile of one sector from the stored data.
+        See sector_profiles."""
+        return self.sector_profiles([(start_angle, end_angle)], min_counts,
+                                    islog, edges)[0]
 
 class Epanda(Region):
     """Generate elliptical sector."""
@@ -76,6 +261,28 @@ class Epanda(Region):
     def make_edges(self, islog):
         return get_edges(self.major_axis, islog)
 
+    def get_bounds(self, length, width):
+        """Get the pixel ranges of the bounding square of the sector.
+
+        Returns (row_min, row_max, col_min, col_max), with the maximum values
+        excluded, clipped to an image with the given length and width.
+        """
+        return get_square_bounds(self.x0, self.y0, self.major_axis,
+                                 length, width)
+
+    def assign_pixels(self, edges, length, width):
+        """Assign the pixels inside the elliptical sector to annuli.
+
+        The polar angles and elliptical radii of all the pixels in the
+        bounding square of the sector are calculated at once (see
+        EllipticalGrid), and the annulus of each pixel is found with a single
+        sorted search over the edges. Returns three integer arrays containing
+        the row, column, and annulus index of the pixels inside the sector,
+        ordered column by column.
+        """
+        grid = EllipticalGrid.from_region(self, (length, width))
+        return grid.assign_pixels(edges, self.start_angle, self.end_angle)
+
     def distribute_pixels(self, edges, length, width):
         """Find the pixels inside an elliptical sector annulus.
 
@@ -83,39 +290,7 @@ class Epanda(Region):
         pixels whose centers are within a certain annulus of the elliptical
         sector.
         """
-        pixels = []
-        x_min_bound = floor(self.x0 - self.major_axis)
-        x_max_bound = floor(self.x0 + self.major_axis)
-        y_min_bound = ceil(self.y0 - self.major_axis)
-        y_max_bound = ceil(self.y0 + self.major_axis)
-
-        for x in range(max(0, x_min_bound), min(x_max_bound+1, width)):
-            for y in range(max(0, y_min_bound), min(y_max_bound+1, length)):
-                x_rel = x - self.x0
-                y_rel = y - self.y0
-                x_rot_back, y_rot_back = rotate_point(self.x0, self.y0,
-                                                      x_rel, y_rel,
-                                                      -self.rot_angle)
-                if x_rot_back - self.x0 >= 0:
-                    r = np.sqrt((x_rot_back - self.x0)**2 + \
-                                (y_rot_back - self.y0)**2)
-                    if r < 1e-10:
-                        xy_angle = self.start_angle
-                    else:
-                        xy_angle = np.arcsin((y_rot_back - self.y0) / r)
-                    if xy_angle < 0:
-                        xy_angle = 2 * np.pi + xy_angle
-                else:
-                    xy_angle = np.arctan((y_rot_back - self.y0) /
-                                         (x_rot_back - self.x0)) + np.pi
-                if self.start_angle <= xy_angle <= self.end_angle:
-                    outer_ellipse_eq = [(x_rot_back - self.x0)**2 / edges[i]**2 +
-                                        (y_rot_back - self.y0)**2 / edges[i]**2 *
-                                        self.major_axis**2 / self.minor_axis**2
-                                        for i in range(1,len(edges))]
-                    for i, eq in enumerate(outer_ellipse_eq[1:]):
-                        if eq < 1:
-                            pixels.append((y, x, i))
-                            break
-
-        return pixels
+        with stage('region.distribute_pixels') as st:
+            rows, cols, bins = self.assign_pixels(edges, length, width)
+            st.count(pixels=len(rows))
+            return list(zip(rows.tolist(), cols.tolist(), bins.tolist()))
@@ -1,18 +1,33 @@
 import pickle
 import os.path
+import time
+import warnings
 
 import numpy as np
 from astropy.modeling.fitting import Fitter
 import corner
 import emcee
-from astropy.modeling.fitting import (_validate_model,
-                                      _fitter_to_model_params,
-                                      _model_to_fit_params, Fitter,
-                                      _convert_input)
+from astropy.modeling.fitting import _validate_model, Fitter, _convert_input
+try:
+    from astropy.modeling.fitting import (_fitter_to_model_params,
+                                          _model_to_fit_params)
+except ImportError:
+    # Newer versions of astropy made these public, and model_to_fit_params
+    # also returns the parameter bounds.
+    from astropy.modeling.fitting import (
+        fitter_to_model_params as _fitter_to_model_params,
+        model_to_fit_params)
+
+    def _model_to_fit_params(model):
+        return model_to_fit_params(model)[:2]
 from tabulate import tabulate
 
+from .mcmc import (ProcessPool, ChainStore, read_chain, is_npy_file,
+                   autocorr_time, is_converged)
+from .models import IntModel
+from . import instrument
 from .optimizers import Minimize
-from .stats import cstat
+from .stats import cstat, cstat_deriv, cstat_with_deriv, cstat_from_vals
 
 def lnprob(mc_params, model, bounds, measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, x):
     min_bounds, max_bounds = bounds
@@ -27,6 +42,54 @@ def lnprob(mc_params, model, bounds, measured_raw_cts, measured_bkg_cts, t_raw,
     lnc = cstat(measured_raw_cts, model, measured_bkg_cts, t_raw, t_bkg, x)
     return lnp - lnc
 
+def fit_bounds(model):
+    """Lower and upper bounds of the free parameters of a model, NaN where
+    a parameter is unbounded."""
+    bounds_model = model.copy()
+    bounds_model.parameters = [bounds_model.bounds[name][0] for name in bounds_model.param_names]
+    # The fit parameters can be a view of the model parameters, so the
+    # lower bounds are copied before the upper bounds are set.
+    min_bounds = np.array(_model_to_fit_params(bounds_model)[0])
+    bounds_model.parameters = [bounds_model.bounds[name][1] for name in bounds_model.param_names]
+    max_bounds = np.array(_model_to_fit_params(bounds_model)[0])
+    return min_bounds, max_bounds
+
+def is_vectorizable(model):
+    """Check if lnprob_batch can evaluate all the walkers at once."""
+    return getattr(model, 'vectorizable', False) and \
+        not any(model.tied.values())
+
+def lnprob_batch(mc_params, model, bounds, measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, x):
+    """Log-probabilities of all the walkers at once.
+
+    `mc_params` is an (nwalkers, ndim) array of the free parameters. The
+    bounds are checked with array comparisons, and models whose evaluate
+    broadcasts over the parameters (vectorizable = True) are evaluated for
+    all the walkers within the bounds in a single call. For the other
+    models, the walkers are evaluated one at a time with lnprob.
+    """
+    mc_params = np.atleast_2d(mc_params)
+    if not is_vectorizable(model):
+        return np.array([lnprob(params, model, bounds, measured_raw_cts,
+                                measured_bkg_cts, t_raw, t_bkg, x)
+                         for params in mc_params])
+
+    min_bounds, max_bounds = bounds
+    in_bounds = np.all((np.isnan(min_bounds) | (mc_params >= min_bounds)) &
+                       (np.isnan(max_bounds) | (mc_params <= max_bounds)),
+                       axis=1)
+
+    # Fill in the fixed parameters; one row of parameters per walker.
+    all_params = np.tile(model.parameters, (np.count_nonzero(in_bounds), 1))
+    all_params[:, _model_to_fit_params(model)[1]] = mc_params[in_bounds]
+    model_vals = model.evaluate(x, *[param[:, np.newaxis]
+                                     for param in all_params.T])
+
+    lnp = np.full(len(mc_params), -np.inf)
+    lnp[in_bounds] = -cstat_from_vals(measured_raw_cts, model_vals,
+                                      measured_bkg_cts, t_raw, t_bkg)
+    return lnp
+
 class CstatFitter(Fitter):
     """
     Fit a model using the C-statistic. [1][2]
@@ -47,6 +110,7 @@ class CstatFitter(Fitter):
     def __init__(self, optimizer=None):
         if optimizer is None:
             optimizer = Minimize()
+        self._optimizer = optimizer
 
         def opt_func(*args, **kwargs):
             return optimizer(*args, **kwargs)
@@ -56,7 +120,7 @@ class CstatFitter(Fitter):
     def __call__(self, model, x, measured_raw_cts, measured_bkg_cts,
                  t_raw, t_bkg, x_err=None, **kwargs):
         if x_err is not None:
-            model = IntModel(model.__class__)(x_err, *model.parameters)
+            model = IntModel(model, x_err)
 
         model_copy = _validate_model(model,
                                      self.supported_constraints)
@@ -65,61 +129,233 @@ class CstatFitter(Fitter):
         p0, _ = _model_to_fit_params(model_copy)
 
         # TODO: Honor estimate_jacobian in kwargs, and/or determine if
-        # model supports jacobian, and/or if fitter supports the jac argument.
+        # fitter supports the jac argument.
+
+        # Models that return their values and derivatives from one pass are
+        # evaluated once per step, with the objective returning both. This
+        # is only done for optimizers that use the derivatives, since they
+        # would otherwise be calculated for nothing.
+        if (hasattr(model_copy, 'evaluate_with_derivatives') and
+                getattr(self._optimizer, 'uses_gradient', False)):
+            objective, jac = self.objective_with_derivative, True
+        else:
+            objective, jac = self.objective_function, self.objective_derivative
 
-        fitparams, self.fit_info = self._opt_method(
-            self.objective_function, p0, farg, jac=self.objective_derivative,
-            **kwargs)
+        # The objective functions are only wrapped when instrumentation is
+        # enabled, so that the fit is not slowed down otherwise. Each call
+        # evaluates the model once, at all the points.
+        if instrument.is_enabled():
+            name = 'fit.objective_with_jacobian' if jac is True \
+                else 'fit.objective'
+            objective = instrument.timed(name, model_evaluations=1,
+                                         points=len(x))(objective)
+            if callable(jac):
+                jac = instrument.timed('fit.jacobian', model_evaluations=1,
+                                       points=len(x))(jac)
+
+        with instrument.collect() as stats, instrument.stage('fit'):
+            fitparams, self.fit_info = self._opt_method(
+                objective, p0, farg, jac=jac, **kwargs)
+        if stats is not None:
+            self.fit_info = dict(self.fit_info, stats=stats)
         _fitter_to_model_params(model_copy, fitparams)
 
         return model_copy
 
     def objective_derivative(self, params, model, measured_bkg_cts, t_raw, t_bkg, x, measured_raw_cts):
         _fitter_to_model_params(model, params)
-        return cstat_deriv(measured_raw_cts, model, measured_bkg_cts,
-                           t_raw, t_bkg, x)
+        derivs = cstat_deriv(measured_raw_cts, model, measured_bkg_cts,
+                             t_raw, t_bkg, x)
+        return derivs[_model_to_fit_params(model)[1]]
+
+    def objective_with_derivative(self, params, model, measured_bkg_cts, t_raw, t_bkg, x, measured_raw_cts):
+        """Return the C-statistic and its derivatives with respect to the
+        free parameters."""
+        _fitter_to_model_params(model, params)
+        stat, derivs = cstat_with_deriv(measured_raw_cts, model,
+                                        measured_bkg_cts, t_raw, t_bkg, x)
+        return stat, derivs[_model_to_fit_params(model)[1]]
 
     def mcmc_err(self, model, x, measured_raw_cts, measured_bkg_cts,
                  t_raw, t_bkg, cl=68.27, nruns=500, nwalkers=100, nburn=100,
                  with_corner=True, corner_filename='triangle.pdf',
                  corner_dpi=144, clobber_corner=True, save_chain=False,
-                 chain_filename='chain.dat', clobber_chain=True,
-                 floatfmt=".3e", tablefmt='orgtbl', **kwargs):
+                 chain_filename='chain.npy', clobber_chain=True,
+                 floatfmt=".3e", tablefmt='orgtbl', workers=None,
+                 chunksize=None, start_method=None, pool=None,
+                 vectorize=None, thin=1, chain_dtype=np.float64,
+                 resume_chain=False, adaptive=False, check_every=100,
+                 ntau=50, tau_rtol=0.01, burn_tau=2., **kwargs):
         """Run Markov Chain Monte Carlo for parameter error estimation.
 
         `model` should be a fitted model as returned by `__call__`.
 
-        Return the Markov Chain as a 3-dimensional array (walker, step, parameter).
+        The walkers are evaluated in parallel by a ProcessPool with `workers`
+        processes (default: the number of CPUs), sending `chunksize` walkers
+        at a time, and using the multiprocessing `start_method`. With
+        `workers=1`, the walkers are evaluated in this process. Any other
+        object with a `map` method can be passed as `pool` instead.
+
+        If `vectorize` is True, the log-probabilities of all the walkers are
+        calculated at once by lnprob_batch, in this process. By default, this
+        is done for models that support it (e.g., Beta), and the walkers of
+        other models are evaluated in the process pool.
+
+        If `save_chain` is True, the walker positions after every `thin`
+        steps are written to `chain_filename` during sampling, as a
+        memory-mapped .npy array of shape (steps, walkers, parameters) with
+        dtype `chain_dtype`, and the number of saved steps to
+        `chain_filename` + '.json'. With `resume_chain=True` (which requires
+        `save_chain`), sampling continues from the last positions saved in
+        an existing chain file. With `clobber_chain=False`, an existing chain
+        file is read (lazily) instead of sampling; `thin` should then be the
+        one the chain was saved with, and `self.mcmc_info` only holds the
+        number of steps read and the burn-in. Chains pickled by earlier
+        versions can still be read.
+
+        With `adaptive=True`, the integrated autocorrelation time of each
+        parameter is estimated every `check_every` steps, and sampling stops
+        once the chain is longer than `ntau` autocorrelation times and the
+        estimates changed by less than `tau_rtol` since the previous check;
+        `nruns` is then the maximum number of steps. The burn-in is set to
+        `burn_tau` times the longest autocorrelation time, instead of
+        `nburn`. The diagnostics of each check (number of steps,
+        autocorrelation times, acceptance fraction since the previous check,
+        and wall time per step) are stored in `self.mcmc_info`, together with
+        the number of steps, the burn-in, and whether the chain converged.
+        If instrumentation is enabled (see pyxel.instrument), the wall time
+        of each sampler step, the walker evaluations, and the accepted moves
+        are stored in `self.mcmc_info['stats']`.
+
+        Return the parameter values and their lower and upper uncertainties.
         """
+        if resume_chain and not save_chain:
+            raise ValueError('resume_chain=True requires save_chain=True.')
         model_copy = _validate_model(model,
                                      self.supported_constraints)
         params, _ = _model_to_fit_params(model_copy)
 
-        # Get bounds
-        bounds_model = model.copy()
-        bounds_model.parameters = [bounds_model.bounds[name][0] for name in bounds_model.param_names]
-        min_bounds, _ = _model_to_fit_params(bounds_model)
-        bounds_model.parameters = [bounds_model.bounds[name][1] for name in bounds_model.param_names]
-        max_bounds, _ = _model_to_fit_params(bounds_model)
+        min_bounds, max_bounds = fit_bounds(model)
 
         ndim = len(params)
-        pos = [params + 1e-4 * np.random.randn(ndim) * params
+        # The walkers start in a small ball around the parameters; parameters
+        # equal to 0 get an absolute scatter instead, otherwise all the
+        # walkers would start with the same value.
+        scale = np.where(params != 0, np.abs(params), 1.)
+        pos = [params + 1e-4 * np.random.randn(ndim) * scale
                for i in range(nwalkers)]
 
-        if not os.path.isfile(chain_filename) or clobber_chain:
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, threads=8,
-                                            args=(model_copy, (min_bounds, max_bounds),
-                                                  measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, x))
-            sampler.run_mcmc(pos, nruns)
-            samples = sampler.chain[:, nburn:, :].reshape((-1, ndim))
-
-            #samples = np.array(result).reshape((-1, ndim))
+        if not os.path.isfile(chain_filename) or clobber_chain or \
+                resume_chain:
+            store = None
+            start = 0
             if save_chain:
-                with open(chain_filename, 'wb') as f:
-                    pickle.dump(samples, f)
-        elif os.path.isfile(chain_filename) and not clobber_chain:
+                store = ChainStore(chain_filename, nruns, nwalkers, ndim,
+                                   thin=thin, dtype=chain_dtype,
+                                   resume=resume_chain)
+                start = store.steps_done
+                if start > 0:
+                    pos = store.last_positions()
+            if vectorize is None:
+                vectorize = is_vectorizable(model_copy)
+            own_pool = pool is None and workers != 1 and not vectorize
+            stats = instrument.Stats() if instrument.is_enabled() else None
+            if own_pool:
+                pool = ProcessPool(workers, chunksize, start_method)
+            try:
+                sampler = emcee.EnsembleSampler(nwalkers, ndim,
+                                                lnprob_batch if vectorize else lnprob,
+                                                pool=pool, vectorize=vectorize,
+                                                args=(model_copy, (min_bounds, max_bounds),
+                                                      measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, x))
+                checkpoints = []
+                converged = False
+                nsteps = start
+                previous_tau = None
+                check_time = time.time()
+                check_step = start
+                # The sampler does not count accepted moves when the chain
+                # is not stored, so they are counted here.
+                accepted = np.zeros(nwalkers)
+                coords = np.asarray(pos, dtype=float)
+                step_start = time.perf_counter()
+                # With a chain file, the steps are only kept on disk.
+                for step, state in enumerate(
+                        sampler.sample(pos, iterations=nruns - start,
+                                       store=store is None), start):
+                    nsteps = step + 1
+                    step_accepted = np.any(state.coords != coords, axis=1)
+                    accepted += step_accepted
+                    coords = state.coords.copy()
+                    if stats is not None:
+                        now = time.perf_counter()
+                        step_counters = dict(
+                            walker_evaluations=nwalkers,
+                            accepted=int(np.sum(step_accepted)))
+                        stats.add('mcmc.step', now - step_start,
+                                  **step_counters)
+                        instrument.record('mcmc.step', now - step_start,
+                                          **step_counters)
+                        step_start = now
+                    if store is not None:
+                        store.add(step, state.coords)
+                    if not adaptive or nsteps % check_every != 0:
+                        continue
+                    if store is not None:
+                        tau = autocorr_time(store.chain[:store.nsaved], thin)
+                    else:
+                        tau = autocorr_time(sampler.get_chain())
+                    now = time.time()
+                    checkpoints.append({
+                        'nsteps': nsteps,
+                        'tau': tau,
+                        'acceptance_fraction': np.mean(accepted) /
+                                               (nsteps - check_step),
+                        'time_per_step': (now - check_time) /
+                                         (nsteps - check_step)})
+                    converged = is_converged(tau, previous_tau, nsteps,
+                                             ntau, tau_rtol)
+                    if converged:
+                        break
+                    previous_tau = tau
+                    check_time = now
+                    check_step = nsteps
+                    accepted[:] = 0.
+            finally:
+                if own_pool:
+                    pool.close()
+                if store is not None:
+                    store.close()
+            self.mcmc_info = {'nsteps': nsteps, 'nburn': nburn,
+                              'converged': converged,
+                              'checkpoints': checkpoints}
+            if stats is not None:
+                self.mcmc_info['stats'] = stats
+            if adaptive and checkpoints:
+                # Keep at least half of the chain if it did not converge.
+                nburn = min(int(np.ceil(burn_tau *
+                                        np.max(checkpoints[-1]['tau']))),
+                            nsteps // 2)
+                self.mcmc_info['nburn'] = nburn
+                self.mcmc_info['tau'] = checkpoints[-1]['tau']
+            if save_chain:
+                samples = read_chain(chain_filename)[nburn // thin:]
+                samples = samples.reshape((-1, ndim))
+            else:
+                samples = sampler.get_chain(discard=nburn, thin=thin,
+                                            flat=True)
+        elif is_npy_file(chain_filename):
+            samples = read_chain(chain_filename)
+            self.mcmc_info = {'nsteps': len(samples) * thin, 'nburn': nburn,
+                              'converged': None, 'checkpoints': []}
+            samples = samples[nburn // thin:].reshape((-1, ndim))
+        else:
+            warnings.warn("Reading a pickled chain; chains are now saved as "
+                          ".npy files.", DeprecationWarning)
             with open(chain_filename, 'rb') as f:
                 samples = pickle.load(f)
+            self.mcmc_info = {'nsteps': None, 'nburn': nburn,
+                              'converged': None, 'checkpoints': []}
 
         par_names = model_copy.param_names
         free_par_names = []
@@ -1,5 +1,9 @@
+import copy
+
 from astropy.io import fits
 
+from .instrument import stage
+
 def clean_header(hdr):
     """Remove unwanted keywords from the image header.
 
@@ -18,8 +22,41 @@ def clean_header(hdr):
             del hdr[key]
     return hdr
 
+def read_fits(filename, ext=0):
+    """Read the data and header of a FITS image into memory.
+
+    The file is closed before returning, so no file handles are left open.
+    """
+    with stage('image.read') as st, \
+            fits.open(filename, memmap=False) as img_hdu:
+        data = img_hdu[ext].data
+        hdr = clean_header(img_hdu[ext].header)
+        st.count(pixels=data.size)
+    return data, hdr
+
+def read_fits_section(filename, ext, section):
+    """Read a rectangular section of a FITS image.
+
+    Only the pixels inside the section are read from disk.
+    """
+    with stage('image.read_section') as st, \
+            fits.open(filename, memmap=True) as img_hdu:
+        data = img_hdu[ext].section[section]
+        st.count(pixels=data.size)
+    return data
+
+def offset_header(hdr, row_min, col_min):
+    """Return a copy of the header with the reference pixel shifted to match
+    an image cut out starting at (row_min, col_min)."""
+    hdr = hdr.copy()
+    if 'CRPIX1' in hdr:
+        hdr['CRPIX1'] -= col_min
+    if 'CRPIX2' in hdr:
+        hdr['CRPIX2'] -= row_min
+    return hdr
+
 class Image():
-    def __init__(self, filename, ext=0):
+    def __init__(self, filename, ext=0, memmap=False):
         """Return a FITS image and the associated header.
 
         The image is returned as a numpy array. By default, the first HDU is read.
@@ -27,24 +64,154 @@ class Image():
         image is modified to remove unncessary keywords such as HISTORY and COMMENT,
         as well as keywords associated with a 3rd and 4th dimension (e.g. NAXIS3,
         NAXIS4).
+
+        If 'memmap' is True, only the headers are read when the image is
+        created. The data are memory-mapped the first time they are accessed,
+        so pixels are only read from disk when they are actually used. The
+        files then stay open until close() is called, or until the end of
+        the 'with' block in which the image is used:
+
+            with Image(filenames, memmap=True) as img:
+                p = region.profile(img, ...)
+
+        The profile cache checksums the data of images read into memory the
+        first time it needs them, and keeps the checksums. They are reset
+        when the data are replaced; after modifying the data in place, call
+        reset_fingerprint().
         """
+        self.filename = filename
+        self.memmap = memmap
+        self._hdus = []
+        self._data = None
+        self._data_checksums = None
         if not isinstance(filename, list):
-            img_hdu = fits.open(filename)
-            self.data = img_hdu[ext].data
-            self.hdr = clean_header(img_hdu[ext].header)
+            self.ext = ext
+            if memmap:
+                self.hdr = clean_header(fits.getheader(filename, ext))
+            else:
+                self._data, self.hdr = read_fits(filename, ext)
         else:
-            img_hdr = []
-            img_data = []
             if ext == 0:
                 ext = [ext] * len(filename)
             elif len(ext) != len(filename):
                 raise IndexError('Length of the extension array must match \
                     number of images.')
-            for i in range(len(filename)):
-                img_hdu = fits.open(filename[i])
-                img_data.append(img_hdu[ext[i]].data)
-                img_hdr.append(clean_header(img_hdu[ext[i]].header))
-            self.data = img_data
-            self.hdr = img_hdr
+            self.ext = ext
+            if memmap:
+                self.hdr = [clean_header(fits.getheader(filename[i], ext[i]))
+                            for i in range(len(filename))]
+            else:
+                img_data, img_hdr = [], []
+                for i in range(len(filename)):
+                    data, hdr = read_fits(filename[i], ext[i])
+                    img_data.append(data)
+                    img_hdr.append(hdr)
+                self._data = img_data
+                self.hdr = img_hdr
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *args):
+        self.close()
 
+    @property
+    def data(self):
+        if self._data is None:
+            if not isinstance(self.filename, list):
+                self._data = self._open_data(self.filename, self.ext)
+            else:
+                self._data = [self._open_data(self.filename[i], self.ext[i])
+                              for i in range(len(self.filename))]
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._data_checksums = None
+
+    def reset_fingerprint(self):
+        """Forget the checksums of the data kept for the profile cache (see
+        pyxel.cache.image_fingerprint), after modifying the data in place."""
+        self._data_checksums = None
+
+    @property
+    def shape(self):
+        """Shape (rows, cols) of the image, read from the header if the data
+        have not been loaded yet. For a list of images, the shape of the
+        first image is returned."""
+        if self._data is not None:
+            data = self._data[0] if isinstance(self._data, list) else self._data
+            return data.shape
+        hdr = self.hdr[0] if isinstance(self.hdr, list) else self.hdr
+        return (hdr['NAXIS2'], hdr['NAXIS1'])
+
+    def cutout(self, row_min, row_max, col_min, col_max):
+        """Return a new Image with a rectangular section of the data.
+
+        The section covers rows row_min to row_max and columns col_min to
+        col_max, with the maximum values excluded. If the data are already
+        available, the cutout is a view into them. Otherwise, only the pixels
+        inside the section are read from disk. Pixel (row_min, col_min) of the
+        image becomes pixel (0, 0) of the cutout.
+        """
+        section = (slice(row_min, row_max), slice(col_min, col_max))
+        cut = copy.copy(self)
+        cut.memmap = False
+        cut._hdus = []
+        cut._data_checksums = None
+        if not isinstance(self.filename, list):
+            if self._data is not None:
+                cut._data = self._data[section]
+            else:
+                cut._data = read_fits_section(self.filename, self.ext,
+                                              section)
+            cut.hdr = offset_header(self.hdr, row_min, col_min)
+        else:
+            if self._data is not None:
+                cut._data = [data[section] for data in self._data]
+            else:
+                cut._data = [read_fits_section(self.filename[i], self.ext[i],
+                                               section)
+                             for i in range(len(self.filename))]
+            cut.hdr = [offset_header(hdr, row_min, col_min)
+                       for hdr in self.hdr]
+        return cut
+
+    def _open_data(self, filename, ext):
+        """Memory-map the data of a FITS image and keep the file open."""
+        with stage('image.memmap'):
+            img_hdu = fits.open(filename, memmap=True)
+        self._hdus.append(img_hdu)
+        return img_hdu[ext].data
+
+    def close(self):
+        """Close the files opened to memory-map the data.
+
+        The memory-mapped data are released as well, and will be mapped again
+        if they are accessed after the image is closed. Images read into
+        memory are not affected.
+        """
+        for img_hdu in self._hdus:
+            img_hdu.close()
+        self._hdus = []
+        if self.memmap:
+            self._data = None
+
+def combine_images(images):
+    """Return an Image made of several single images, e.g. the ObsIDs of a
+    stack.
+
+    The new image shares the headers and data of the images, so the files
+    of memory-mapped images are not opened again. Closing the new image
+    does not close the files of the images.
+    """
+    img = copy.copy(images[0])
+    img.filename = [i.filename for i in images]
+    img.ext = [i.ext for i in images]
+    img.memmap = all(i.memmap for i in images)
+    img.hdr = [i.hdr for i in images]
+    img._hdus = []
+    img._data = [i.data for i in images]
+    img._data_checksums = None
+    return img
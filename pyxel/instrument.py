@@ -0,0 +1,169 @@
+"""Opt-in timing and counters of the extraction and fitting stages.
+
+Instrumentation is disabled by default, in which case the stages cost a
+single flag check. Once enabled with enable_instrumentation(), each stage
+records its wall time, number of calls, and counters (e.g., pixels, model
+evaluations, sampler steps):
+
+    from pyxel.instrument import enable_instrumentation, global_stats
+    enable_instrumentation()
+    p = region.profile(counts_img, bkg_img, exp_img)
+    print(p.stats)          # stages of this profile
+    print(global_stats)     # stages of all the runs so far
+
+The stats of a profile are attached to the returned ProfileTable as
+`stats`, and those of a fit to CstatFitter.fit_info['stats'] (and, for
+MCMC, CstatFitter.mcmc_info['stats']). Stage times are inclusive, so the
+time of a stage also counts towards the stages that enclose it.
+"""
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from tabulate import tabulate
+
+_enabled = False
+# Stats objects collecting the stages of the runs in progress.
+_collectors = []
+
+class Stats(object):
+    """Wall time, number of calls, and counters of each stage."""
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def add(self, name, elapsed=0., calls=1, **counters):
+        """Add a call (or several) of a stage."""
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = OrderedDict(calls=0, time=0.)
+        stage['calls'] += calls
+        stage['time'] += elapsed
+        for key, value in counters.items():
+            stage[key] = stage.get(key, 0) + value
+
+    def merge(self, other):
+        """Add the stages of another Stats object to this one."""
+        for name, stage in other.stages.items():
+            stage = dict(stage)
+            self.add(name, stage.pop('time'), stage.pop('calls'), **stage)
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def __contains__(self, name):
+        return name in self.stages
+
+    def as_dict(self):
+        """Return the stages as a dictionary of dictionaries, e.g. to save
+        them as JSON."""
+        return {name: dict(stage) for name, stage in self.stages.items()}
+
+    def clear(self):
+        self.stages.clear()
+
+    def __repr__(self):
+        if not self.stages:
+            return '<Stats with no stages>'
+        rows = []
+        for name, stage in self.stages.items():
+            counters = ', '.join('%s=%s' % (key, value)
+                                 for key, value in stage.items()
+                                 if key not in ('calls', 'time'))
+            rows.append([name, stage['calls'], stage['time'], counters])
+        return tabulate(rows, headers=['Stage', 'Calls', 'Time (s)',
+                                       'Counters'], floatfmt='.4f')
+
+global_stats = Stats()
+
+def enable_instrumentation():
+    """Start recording the stages."""
+    global _enabled
+    _enabled = True
+
+def disable_instrumentation():
+    """Stop recording the stages."""
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def record(name, elapsed=0., calls=1, **counters):
+    """Record a stage whose time was measured by the caller."""
+    if not _enabled:
+        return
+    global_stats.add(name, elapsed, calls, **counters)
+    for stats in _collectors:
+        stats.add(name, elapsed, calls, **counters)
+
+class _Stage(object):
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = counters
+
+    def count(self, **counters):
+        """Add to the counters of the stage."""
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, time.perf_counter() - self.start, **self.counters)
+
+class _NullStage(object):
+    def count(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_stage = _NullStage()
+
+def stage(name, **counters):
+    """Context manager that records the wall time of a stage.
+
+    Counters can be given here, or added with the count method of the
+    returned object:
+
+        with stage('profile.bin_sums') as st:
+            ...
+            st.count(pixels=len(rows))
+    """
+    if not _enabled:
+        return _null_stage
+    return _Stage(name, dict(counters))
+
+def timed(name, **counters):
+    """Decorator that records each call of a function as a stage. It should
+    only be applied when instrumentation is enabled, e.g. to wrap the
+    objective function of a fit."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name, **counters):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def collect():
+    """Collect the stages recorded in the enclosed block.
+
+    Yields a new Stats object, or None if instrumentation is disabled.
+    """
+    if not _enabled:
+        yield None
+        return
+    stats = Stats()
+    _collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        _collectors.remove(stats)
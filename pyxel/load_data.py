@@ -1,39 +1,89 @@
+import logging
+
 from .image import Image
 from .box import Box
 from .epanda import Epanda
+from .messages import ErrorMessages
+
+logger = logging.getLogger(__name__)
+
+REGIONS = {'box': Box.from_params,
+           'epanda': Epanda.from_epanda_params,
+           'panda': Epanda.from_panda_params,
+           'circle': Epanda.from_circle_params,
+           'ellipse': Epanda.from_ellipse_params}
 
-def read_shape(data):
+# Coordinate systems that DS9 can write before the region definitions.
+COORD_SYSTEMS = {'image', 'physical', 'detector', 'amplifier', 'linear',
+                 'fk4', 'fk5', 'b1950', 'j2000', 'icrs', 'galactic',
+                 'ecliptic', 'wcs'}
+
+def read_shape(reg_def):
     """Get region shape and parameters.
 
     Splits the DS9 region definition into a string describing the region shape
     (e.g. box, circle) and a list of floats containing the parameters of the
     region.
     """
-    reg_def = data[3].strip()
-    shape = reg_def.split(r'(')[0]
-    params = [float(i) for i in reg_def.split(r'(')[1].strip(')').split(',')]
+    reg_def = reg_def.strip()
+    shape = reg_def.split(r'(')[0].strip()
+    params = [float(i) for i in reg_def.split(r'(')[1].split(r')')[0].split(',')]
     return (shape, params)
 
+def read_shapes(filename):
+    """Read all the region definitions in a DS9 region file.
+
+    The '# Region file format' header, other comments, and the 'global'
+    line are skipped, as are the properties after '#' on region lines.
+    Several definitions on one line can be separated by ';'. All the
+    regions should be defined in image coordinates. Returns a list of
+    (shape, params) tuples, in the order of the file.
+    """
+    shapes = []
+    coord_system = None
+    with open(filename) as reg_file:
+        for line in reg_file:
+            line = line.split('#')[0]
+            for reg_def in line.split(';'):
+                reg_def = reg_def.strip()
+                if not reg_def or reg_def.startswith('global'):
+                    continue
+                if reg_def.lower() in COORD_SYSTEMS:
+                    coord_system = reg_def.lower()
+                    continue
+                if coord_system != 'image':
+                    raise ValueError(ErrorMessages('002'))
+                shape, params = read_shape(reg_def.lstrip('+'))
+                if shape.startswith('-'):
+                    raise ValueError(ErrorMessages('005'))
+                if shape not in REGIONS:
+                    raise ValueError(ErrorMessages('004') +
+                                     ' Found: %s.' % shape)
+                shapes.append((shape, params))
+    return shapes
+
+def load_regions(filename):
+    """Read all the regions in a DS9 region file.
+
+    Reads a DS9 region file in which the regions are defined in image
+    coordinates, and returns a list of Box and Epanda regions, in the order
+    of the file. Compound and excluded regions are not supported.
+    """
+    regions = []
+    for shape, params in read_shapes(filename):
+        regions.append(REGIONS[shape](params))
+        logger.info("Region loaded: %s %s", shape, params)
+    return regions
+
 def load_region(filename):
     """Read DS9 region file.
 
     Reads a DS9 region file in which the region is defined in image coordinates.
-    The region file should contain a single region. Compound regions are not
-    supported currently.
+    The region file should contain a single region; files with several regions
+    can be read with load_regions. Compound regions are not supported currently.
     """
-    reg_file = open(filename)
-    regions = {'box': Box.from_params,
-               'epanda': Epanda.from_epanda_params,
-               'panda': Epanda.from_panda_params,
-               'circle': Epanda.from_circle_params,
-               'ellipse': Epanda.from_ellipse_params}
-    data = reg_file.readlines()
-    if len(data) != 4 or data[2].strip() != 'image':
-        error_message = ErrorMessages('002')
+    regions = load_regions(filename)
+    if len(regions) != 1:
+        error_message = ErrorMessages('006')
         raise ValueError(error_message)
-    else:
-        shape, params = read_shape(data)
-        region = regions[shape](params)
-        print("Region loaded. Its shape and parameters are listed below: ")
-        print(shape, params)
-        return region
+    return regions[0]
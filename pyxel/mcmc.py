@@ -0,0 +1,198 @@
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.format import open_memmap
+import emcee
+
+class ProcessPool(object):
+    """Process pool that emcee can use to evaluate the walkers in parallel.
+
+    The likelihood is mostly Python code, so threads do not speed it up;
+    the walkers are instead sent to `workers` processes (default: the number
+    of CPUs). The model and data are pickled with each chunk of walkers, so
+    `chunksize` walkers are sent to a process at a time (default: the
+    walkers are split evenly between the processes). `start_method` is the
+    multiprocessing start method ('fork', 'spawn', or 'forkserver'; default:
+    the platform default).
+
+    The pool can be passed to emcee.EnsembleSampler as `pool`, and should be
+    closed after sampling, or used as a context manager.
+    """
+    def __init__(self, workers=None, chunksize=None, start_method=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.chunksize = chunksize
+        self.start_method = start_method
+        context = multiprocessing.get_context(start_method)
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=context)
+
+    def map(self, fn, iterable):
+        items = list(iterable)
+        chunksize = self.chunksize
+        if chunksize is None:
+            chunksize = max(1, int(math.ceil(len(items) / self.workers)))
+        return list(self._executor.map(fn, items, chunksize=chunksize))
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def autocorr_time(chain, thin=1):
+    """Integrated autocorrelation time of each parameter, in sampler steps.
+
+    `chain` has shape (steps, walkers, parameters) and holds every `thin`-th
+    step. The estimate is emcee's, averaged over the walkers; checking if the
+    chain is long enough for the estimate to be reliable is left to the
+    caller.
+    """
+    chain = np.asarray(chain, dtype=float)
+    return thin * emcee.autocorr.integrated_time(chain, tol=0)
+
+def is_converged(tau, previous_tau, nsteps, ntau=50, tau_rtol=0.01):
+    """Check if a chain of nsteps steps has converged.
+
+    The chain should be longer than `ntau` autocorrelation times for all the
+    parameters, and the estimates of the autocorrelation times should have
+    changed by less than `tau_rtol` since the previous check.
+    """
+    if previous_tau is None or not np.all(np.isfinite(tau)):
+        return False
+    return bool(np.all(ntau * tau < nsteps) and
+                np.all(np.abs(tau - previous_tau) < tau_rtol * tau))
+
+def is_npy_file(filename):
+    """Check if a file starts with the .npy magic string."""
+    with open(filename, 'rb') as f:
+        return f.read(6) == b'\x93NUMPY'
+
+def count_saved_steps(chain):
+    """Number of leading steps of a stored chain that have been written.
+
+    The chain files are filled with NaN when created, and the walker
+    positions are always finite, so the steps that were saved are the ones
+    without NaN. This reads the whole chain, so it is only used for chain
+    files without a progress file (see chain_progress).
+    """
+    complete = np.isfinite(chain).all(axis=(1, 2))
+    return len(complete) if complete.all() else int(np.argmin(complete))
+
+def progress_filename(filename):
+    """Name of the JSON file recording the progress of a chain file."""
+    return filename + '.json'
+
+def write_progress(filename, nsaved, thin):
+    """Record the number of saved steps of a chain file, and its thinning
+    factor. The file is replaced atomically, so it is never half-written."""
+    progress_file = progress_filename(filename)
+    tmp_filename = progress_file + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({'nsaved': nsaved, 'thin': thin}, f)
+    os.replace(tmp_filename, progress_file)
+
+def chain_progress(filename, chain):
+    """Return the number of saved steps of a chain file and its thinning
+    factor (None if unknown).
+
+    They are read from the progress file written by ChainStore, or, for
+    chain files saved without one, the saved steps are counted by scanning
+    the chain.
+    """
+    try:
+        with open(progress_filename(filename)) as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return count_saved_steps(chain), None
+    return min(progress['nsaved'], len(chain)), progress['thin']
+
+def read_chain(filename):
+    """Read the saved steps of a chain file, memory-mapped and read-only.
+
+    Returns an array of shape (steps, walkers, parameters). The data is only
+    read from disk when it is accessed.
+    """
+    chain = np.load(filename, mmap_mode='r')
+    return chain[:chain_progress(filename, chain)[0]]
+
+class ChainStore(object):
+    """MCMC chain written to a memory-mapped .npy file during sampling.
+
+    The file holds an array of shape (nsteps // thin, nwalkers, ndim) with
+    the walker positions after every `thin` steps, stored with the given
+    dtype (e.g. np.float32 to halve the file size). The file is created at
+    full size and filled with NaN, and each saved step is flushed to disk,
+    so a killed run keeps all the steps saved until then. The number of
+    saved steps is recorded next to the chain, in `filename` + '.json', so
+    that it can be read without scanning the chain.
+
+    With `resume=True`, an existing file with the same shape is reopened,
+    and `steps_done` and `last_positions` tell where to continue from.
+    """
+    def __init__(self, filename, nsteps, nwalkers, ndim, thin=1,
+                 dtype=np.float64, resume=False):
+        self.filename = filename
+        self.thin = thin
+        shape = (nsteps // thin, nwalkers, ndim)
+        if resume and os.path.isfile(filename):
+            self.chain = np.load(filename, mmap_mode='r+')
+            if self.chain.shape != shape:
+                raise ValueError('Cannot resume from %s: the chain has '
+                                 'shape %s instead of %s.' %
+                                 (filename, self.chain.shape, shape))
+            self.nsaved, saved_thin = chain_progress(filename, self.chain)
+            if saved_thin is not None and saved_thin != thin:
+                raise ValueError('Cannot resume from %s: the chain was '
+                                 'saved with thin=%d instead of %d.' %
+                                 (filename, saved_thin, thin))
+        else:
+            self.chain = open_memmap(filename, mode='w+', dtype=dtype,
+                                     shape=shape)
+            self.chain[:] = np.nan
+            self.chain.flush()
+            self.nsaved = 0
+            write_progress(filename, 0, thin)
+
+    @property
+    def steps_done(self):
+        """Number of sampler steps covered by the saved chain."""
+        return self.nsaved * self.thin
+
+    def last_positions(self):
+        """Walker positions at the last saved step, or None."""
+        if self.nsaved == 0:
+            return None
+        return np.array(self.chain[self.nsaved - 1], dtype=float)
+
+    def add(self, step, coords):
+        """Save the walker positions after `step` + 1 sampler steps, if the
+        step is a multiple of the thinning factor."""
+        if (step + 1) % self.thin != 0:
+            return
+        row = (step + 1) // self.thin - 1
+        if row >= len(self.chain):
+            return
+        self.chain[row] = coords
+        self.chain.flush()
+        self.nsaved = row + 1
+        # The progress is only recorded once the step is on disk.
+        write_progress(self.filename, self.nsaved, self.thin)
+
+    def close(self):
+        self.chain.flush()
+        del self.chain
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
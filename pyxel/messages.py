@@ -8,8 +8,14 @@ def ErrorMessages(error_number):
         '001': '''Too few net counts in the region.
             Enlarge the region or lower the minimum
             count threshold.''',
-        '002': '''Currently only region files with one
-            region defined in image coordinates are supported.'''
+        '002': '''Currently only regions defined in image
+            coordinates are supported.''',
+        '004': '''Unsupported region shape. The supported shapes
+            are box, epanda, panda, circle, and ellipse.''',
+        '005': '''Excluded regions are not supported.''',
+        '006': '''The region file should define exactly one
+            region. Use load_regions to read files with several
+            regions.'''
     }
     return tw.fill(remove_whitespace(errors[error_number]), 80)
 
@@ -5,6 +5,10 @@ from astropy.modeling.optimizers import Optimization
 from astropy.utils.exceptions import AstropyUserWarning
 
 DEFAULT_BOUNDS = (-1e12, 1e12)
+# Methods of scipy.optimize.minimize that use the gradient.
+GRADIENT_METHODS = ('cg', 'bfgs', 'newton-cg', 'l-bfgs-b', 'tnc', 'slsqp',
+                    'dogleg', 'trust-ncg', 'trust-krylov', 'trust-exact',
+                    'trust-constr')
 
 class Minimize(Optimization):
     """General optimization algorithm based on `scipy.optimize.minimize`.
@@ -16,7 +20,11 @@ class Minimize(Optimization):
 
     def __init__(self, method='Nelder-Mead'):
         from scipy.optimize import minimize
-        super(Minimize, self).__init__(minimize)
+        if hasattr(Optimization, '_init_opt_method'):
+            # Newer versions of astropy set the method outside __init__.
+            self._init_opt_method(minimize)
+        else:
+            super(Minimize, self).__init__(minimize)
         method = method.lower()
         self.supported_constraints = ['fixed', 'tied']
         if method in ['l-bfgs-b', 'tnc']:
@@ -33,6 +41,11 @@ class Minimize(Optimization):
         }
         self.method = method
 
+    @property
+    def uses_gradient(self):
+        """Whether the method uses the derivatives of the objective."""
+        return self.method in GRADIENT_METHODS
+
     def __call__(self, objfunc, initval, fargs, **kwargs):
         """
         Run the solver.
@@ -80,7 +93,7 @@ class Minimize(Optimization):
                 if i[1] is None:
                     i[1] = DEFAULT_BOUNDS[1]
             # older versions of scipy require this array to be float
-            kwargs['bounds'] = np.asarray(bounds, dtype=np.float)
+            kwargs['bounds'] = np.asarray(bounds, dtype=float)
 
         kwargs['constraints'] = ()
         if 'eqcons' in self.supported_constraints:
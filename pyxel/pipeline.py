@@ -0,0 +1,333 @@
+"""Batch extraction and fitting of surface brightness profiles.
+
+The regions, images, and models are listed in a JSON manifest:
+
+    {
+        "output": "results.ecsv",
+        "work_dir": "pyxel_jobs",
+        "images": {
+            "zwcl2341": {"counts": ["srcfree_5786.img", ...],
+                         "bkg": ["5786_bgstow.img", ...],
+                         "exp": ["srcfree_5786.expmap", ...]}
+        },
+        "jobs": [
+            {"name": "ne", "region": "ne.reg", "images": "zwcl2341",
+             "min_counts": 25, "islog": false,
+             "fit": {"model": "BrokenPow", "rmin": 0.8, "rmax": 2.5,
+                     "params": {"ind1": 0.0, "ind2": 1.2, "norm": 3.5e-5,
+                                "rbreak": 1.36, "jump": 2.5,
+                                "const": 5.45e-7},
+                     "fixed": ["const"], "integrate": true,
+                     "maxiter": 500},
+             "mcmc": {"cl": 90.0, "nruns": 500}}
+        ]
+    }
+
+Relative paths are relative to the directory of the manifest. "bkg" and
+"exp" are optional, and so are "fit" and "mcmc"; the other keys of "fit"
+are passed to CstatFitter, and the keys of "mcmc" to mcmc_err.
+
+The jobs are run in parallel by a pool of processes, and each process
+opens each image file only once, the first time one of its jobs needs it,
+so image sets that share ObsIDs share the opened files. The result of each
+job is saved in the work directory as soon as the job finishes, together
+with a hash of the job and of the contents of its region and image files,
+and jobs that already finished with the same definition and files are
+skipped when the pipeline is run again, so only failed, missing, or
+modified jobs are recomputed, including jobs whose images were reprocessed
+under the same file names. All the results are then collected in one table.
+"""
+import argparse
+import json
+import logging
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from astropy.table import Table
+
+from . import models
+from .cache import file_checksum, hash_key
+from .image import Image, combine_images
+from .load_data import load_region
+
+logger = logging.getLogger(__name__)
+
+# Image files opened by this process, by file name (see open_images).
+_open_files = {}
+
+def read_manifest(filename):
+    """Read a manifest, and make its paths absolute."""
+    with open(filename) as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(filename))
+
+    def resolve(path):
+        return os.path.join(base_dir, path)
+
+    manifest['output'] = resolve(manifest.get('output', 'results.ecsv'))
+    manifest['work_dir'] = resolve(manifest.get('work_dir', 'pyxel_jobs'))
+    for image_set in manifest['images'].values():
+        for img_type, filenames in image_set.items():
+            if isinstance(filenames, list):
+                image_set[img_type] = [resolve(fn) for fn in filenames]
+            else:
+                image_set[img_type] = resolve(filenames)
+    for job in manifest['jobs']:
+        job['region'] = resolve(job['region'])
+    return manifest
+
+def job_filename(work_dir, name):
+    return os.path.join(work_dir, '%s.json' % name)
+
+def save_json(filename, data):
+    """Write a JSON file atomically, so interrupted runs leave no partial
+    results behind."""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_filename, filename)
+
+def load_result(work_dir, name):
+    """Return the saved result of a job, or None if it has not run yet."""
+    filename = job_filename(work_dir, name)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def job_file_checksum(filename):
+    """Checksum of the contents of a file, or None if it is missing (the
+    job then fails when it runs)."""
+    try:
+        return file_checksum(filename)
+    except OSError:
+        return None
+
+def job_hash(job, image_set):
+    """Hash of the definition of a job and of the contents of its region
+    and image files, used to detect jobs modified since their result was
+    saved."""
+    checksums = {job['region']: job_file_checksum(job['region'])}
+    for filenames in image_set.values():
+        if not isinstance(filenames, list):
+            filenames = [filenames]
+        for filename in filenames:
+            checksums[filename] = job_file_checksum(filename)
+    return hash_key(json.dumps([job, image_set, checksums], sort_keys=True))
+
+def open_file(filename):
+    """Open an image file, or return it if this process opened it
+    already."""
+    img = _open_files.get(filename)
+    if img is None:
+        img = Image(filename, memmap=True)
+        _open_files[filename] = img
+    return img
+
+def open_images(image_set):
+    """Open the counts, background, and exposure images of an image set.
+
+    The images are memory-mapped, so only the pixels in the regions are
+    read. Each file is opened once per process, and shared by all the image
+    sets that include it; this costs little memory.
+    """
+    imgs = {}
+    for img_type in ('counts', 'bkg', 'exp'):
+        filenames = image_set.get(img_type)
+        if filenames is None:
+            imgs[img_type] = None
+        elif isinstance(filenames, list):
+            imgs[img_type] = combine_images([open_file(fn)
+                                             for fn in filenames])
+        else:
+            imgs[img_type] = open_file(filenames)
+    return imgs
+
+def fit_profile(profile, fit, mcmc, chain_filename):
+    """Fit a model to a profile, and optionally run MCMC for the errors.
+
+    Returns a dictionary with the fitted parameters, the final value of the
+    C-statistic, and the median and lower and upper uncertainties of the
+    free parameters from MCMC.
+    """
+    # Imported here, so that the profiles can be extracted even if the
+    # fitting dependencies are missing.
+    from .fitters import CstatFitter
+
+    fit = dict(fit)
+    model_cls = getattr(models, fit.pop('model'))
+    params = fit.pop('params', {})
+    fixed = fit.pop('fixed', [])
+    integrate = fit.pop('integrate', False)
+    data = profile.select(fit.pop('rmin', -np.inf), fit.pop('rmax', np.inf))
+    fit_args = (data['r'], data['raw_cts'], data['bkg_cts'], data['t_raw'],
+                data['t_bkg'])
+
+    model = model_cls(**params)
+    for name in fixed:
+        getattr(model, name).fixed = True
+    fitter = CstatFitter()
+    x_err = data['r_err'] if integrate else None
+    fitted_model = fitter(model, *fit_args, x_err=x_err, **fit)
+
+    result = {'nbins_fit': len(data),
+              'cstat': float(fitter.fit_info['final_func_val'])}
+    for name, value in zip(fitted_model.param_names,
+                           fitted_model.parameters):
+        result[name] = float(value)
+
+    if mcmc is not None:
+        mcmc = dict(mcmc)
+        mcmc.setdefault('with_corner', False)
+        mcmc.setdefault('workers', 1)
+        if mcmc.get('save_chain'):
+            mcmc.setdefault('chain_filename', chain_filename)
+        # The fitted model keeps the fixed parameters and, with integrate,
+        # the bin widths, so MCMC samples the same model as the fit.
+        fit_data = fitter.mcmc_err(fitted_model, *fit_args, **mcmc)
+        for name, value, lower, upper in fit_data:
+            result[name + '_median'] = float(value)
+            result[name + '_lower'] = float(lower)
+            result[name + '_upper'] = float(upper)
+    return result
+
+def run_job(job, imgs, work_dir, digest=None):
+    """Extract the profile of one job and fit it. Returns the result, which
+    is also saved in the work directory, with the job hash `digest`."""
+    name = job['name']
+    result = {'name': name, 'region': job['region'],
+              'images': job['images'], 'job_hash': digest}
+    try:
+        region = load_region(job['region'])
+        profile = region.profile(imgs['counts'], imgs['bkg'], imgs['exp'],
+                                 min_counts=job.get('min_counts', 50),
+                                 islog=job.get('islog', True))
+        Table(profile.data).write(os.path.join(work_dir,
+                                               '%s.profile.ecsv' % name),
+                                  format='ascii.ecsv', overwrite=True)
+        result['nbins'] = len(profile)
+        if job.get('fit') is not None:
+            chain_filename = os.path.join(work_dir, '%s.chain.npy' % name)
+            result.update(fit_profile(profile, job['fit'], job.get('mcmc'),
+                                      chain_filename))
+        result['status'] = 'ok'
+    except Exception as err:
+        result['status'] = 'failed'
+        result['error'] = '%s: %s' % (err.__class__.__name__, err)
+        result['traceback'] = traceback.format_exc()
+    save_json(job_filename(work_dir, name), result)
+    return result
+
+def run_pooled_job(job, image_set, work_dir, digest=None):
+    """Run a job in a pool process, with the image files already opened
+    by the process (see open_images)."""
+    try:
+        imgs = open_images(image_set)
+    except Exception as err:
+        result = {'name': job['name'], 'region': job['region'],
+                  'images': job['images'], 'job_hash': digest,
+                  'status': 'failed',
+                  'error': '%s: %s' % (err.__class__.__name__, err),
+                  'traceback': traceback.format_exc()}
+        save_json(job_filename(work_dir, job['name']), result)
+        return result
+    return run_job(job, imgs, work_dir, digest)
+
+def results_table(results):
+    """Collect the results of all the jobs in a table, one row per job.
+
+    Values missing for a job (e.g., the fit of a failed job) are masked.
+    """
+    colnames = []
+    for result in results:
+        for key in result:
+            if key not in colnames and key not in ('traceback', 'job_hash'):
+                colnames.append(key)
+    columns = []
+    for name in colnames:
+        values = [result.get(name) for result in results]
+        mask = [value is None for value in values]
+        present = [value for value in values if value is not None]
+        fill = '' if isinstance(present[0], str) else 0
+        column = np.ma.array([fill if value is None else value
+                              for value in values], mask=mask)
+        columns.append(column)
+    return Table(columns, names=colnames, masked=True)
+
+def run_pipeline(manifest, workers=None, force=False):
+    """Run the jobs of a manifest and write the results table.
+
+    The jobs are run by at most `workers` processes (default: the number
+    of CPUs). Jobs with a saved successful result for the same job
+    definition and images are skipped, unless `force` is True. The progress
+    is logged to the pyxel.pipeline logger. Returns the results table.
+    """
+    work_dir = manifest['work_dir']
+    os.makedirs(work_dir, exist_ok=True)
+
+    names = [job['name'] for job in manifest['jobs']]
+    if len(set(names)) != len(names):
+        raise ValueError('The job names in the manifest are not unique.')
+
+    results = {}
+    pending = []
+    for job in manifest['jobs']:
+        image_set = manifest['images'][job['images']]
+        digest = job_hash(job, image_set)
+        result = None if force else load_result(work_dir, job['name'])
+        if result is not None and result['status'] == 'ok' and \
+                result.get('job_hash') == digest:
+            results[job['name']] = result
+        else:
+            pending.append((job, image_set, digest))
+    logger.info("Running %d jobs, skipping %d that already finished.",
+                len(pending), len(results))
+
+    if pending:
+        # The jobs of an image set are submitted together, so the processes
+        # mostly reuse the images they already opened.
+        pending.sort(key=lambda args: args[0]['images'])
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_pooled_job, job, image_set,
+                                       work_dir, digest)
+                       for job, image_set, digest in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result['name']] = result
+                if result['status'] == 'ok':
+                    logger.info("Finished job %s.", result['name'])
+                else:
+                    logger.warning("Job %s failed: %s", result['name'],
+                                   result['error'])
+
+    table = results_table([results[name] for name in names])
+    table.write(manifest['output'], format='ascii.ecsv', overwrite=True)
+    return table
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Extract and fit surface brightness profiles for the '
+                    'regions listed in a JSON manifest.')
+    parser.add_argument('manifest', help='JSON manifest of the jobs')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='results table (overrides the manifest)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rerun jobs that already finished')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    manifest = read_manifest(args.manifest)
+    if args.output is not None:
+        manifest['output'] = os.path.abspath(args.output)
+    table = run_pipeline(manifest, workers=args.workers, force=args.force)
+    nfailed = int(np.sum(table['status'] != 'ok'))
+    print("%d jobs finished, %d failed. Results written to %s." %
+          (len(table) - nfailed, nfailed, manifest['output']))
+    return 1 if nfailed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,169 +1,186 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
-from .utils import rotate_point, bin_pix2arcmin, get_bkg_exp
+from .utils import (rotate_point, bin_pix2arcmin, get_bkg_exp,
+                    get_obs_data, get_bin_sums, get_bin_stats, get_cutout,
+                    read_obs_data, get_pix2arcmin)
 from .messages import ErrorMessages
 from .image import Image
+from .cache import label_cache, get_profile_cache
+from .table import ProfileTable
+from .instrument import stage, collect, record
+
+# Regions are read together if the section covering them is at most this
+# many times larger than their own sections (see group_regions).
+GROUP_AREA_RATIO = 2.
 
 class Region(object):
 
+    def get_key(self):
+        """Return a hashable description of the region geometry."""
+        params = sorted((name, float(value))
+                        for name, value in vars(self).items()
+                        if not name.startswith('_'))
+        return (self.__class__.__name__,) + tuple(params)
+
+    def get_pixels(self, edges, length, width):
+        """Return the (row, col, bin) arrays of the pixels in the region.
+
+        Same as assign_pixels, but the label map is looked up in the label
+        cache first, so the pixels are only assigned to bins once for the
+        same geometry, edges, and image shape.
+        """
+        key = (self.get_key(), tuple(float(edge) for edge in edges),
+               (length, width))
+        entry = label_cache.get(key)
+        if entry is not None:
+            flat, bins = entry
+            record('region.label_cache_hit', pixels=len(bins))
+            rows, cols = np.divmod(flat, width)
+            return rows, cols, bins
+        with stage('region.assign_pixels') as st:
+            rows, cols, bins = self.assign_pixels(edges, length, width)
+            st.count(pixels=len(rows))
+        label_cache.put(key, rows * width + cols, bins)
+        return rows, cols, bins
+
     def get_bin_vals(self, counts_img, bkg_img,
         exp_img, pixels_in_bin, only_net_cts=False):
-        """Calculate the number of counts in a bin."""
-
-        if not isinstance(counts_img.data, list):
-            bkg_corr = [None]
-            counts_img_data, counts_img_hdr = [], []
-            counts_img_data.append(counts_img.data)
-            counts_img_hdr.append(counts_img.hdr)
-
-            bkg_img_data, bkg_img_hdr = [], []
-            exp_img_data = []
-
-            if isinstance(bkg_img, Image):
-                if isinstance(bkg_img.data, list):
-                    raise TypeError('If the counts image is a single map, then \
-                              the background image cannot be a list of maps.')
-                else:
-                    bkg_img_data.append(bkg_img.data)
-                    bkg_img_hdr.append(bkg_img.hdr)
-            else:
-                bkg_img_data.append(bkg_img)
-                bkg_corr = [1.]
-                bkg_img_hdr = None
-
-            if isinstance(exp_img, Image):
-                if isinstance(exp_img.data, list):
-                    raise TypeError('If the counts image is a single map, then \
-                              the exposure image cannot be a list of maps.')
-                else:
-                    exp_img_data.append(exp_img.data)
-            else:
-                exp_img_data.append(exp_img)
+        """Calculate the number of counts in a bin.
 
-        else:
-            bkg_corr = [None] * len(counts_img.data)
-            counts_img_data = counts_img.data
-            counts_img_hdr = counts_img.hdr
-
-            if isinstance(exp_img, Image):
-                if not isinstance(exp_img.data, list):
-                    exp_img_data = exp_img.data * len(counts_img.data)
-                elif len(exp_img.data) != len(counts_img.data):
-                    raise ValueError('Exposure map must be either a single \
-                        image, or a list of images with the same length as \
-                        the length of the list of source images.')
-                else:
-                    exp_img_data = exp_img.data
-            else:
-                exp_img_data = exp_img
-
-            if isinstance(bkg_img, Image):
-                if not isinstance(bkg_img.data, list):
-                    bkg_img_data = bkg_img.data * len(counts_img.data)
-                    bkg_img_hdr = bkg_img.hdr * len(counts_img.data)
-                elif len(bkg_img.data) != len(counts_img.data):
-                    raise ValueError('Background map must be either a single \
-                        image, or a list of images with the same length as \
-                        the length of the list of source images.')
-                else:
-                    bkg_img_data = bkg_img.data
-                    bkg_img_hdr = bkg_img.hdr
-            else:
-                bkg_img_data = bkg_img
-                bkg_corr = [1.] * len(counts_img_data)
-                bkg_img_hdr = None
-
-        raw_cts, net_cts, bkg_cts = 0., 0., 0.
-        raw_rate, net_rate, bkg_rate = 0., 0., 0.
-        err_raw_rate_sq, err_net_rate_sq, err_bkg_rate_sq = 0., 0., 0.
-
-        exp_raw = 0.
-        exp_bkg = 0.
-        for i in range(len(counts_img_data)):
-            if 'EXPOSURE' in counts_img_hdr[i]:
-                counts_img_exp = counts_img_hdr[i]['EXPOSURE']
-            elif 'ONTIME' in counts_img_hdr[i]:
-                counts_img_exp = counts_img_hdr[i]['ONTIME']
-            if bkg_img_hdr is not None:
-                if 'EXPOSURE' in bkg_img_hdr[i]:
-                    bkg_img_exp = bkg_img_hdr[i]['EXPOSURE']
-                elif 'ONTIME' in bkg_img_hdr[i]:
-                    bkg_img_exp = bkg_img_hdr[i]['ONTIME']
-
-            if not bkg_corr[i]:
-                if not 'BKGNORM' in bkg_img_hdr[i]:
-                    bkgnorm = 1.
-                else:
-                    bkgnorm = bkg_img_hdr[i]['BKGNORM']
-                bkg_corr_i = counts_img_exp * bkgnorm / bkg_img_exp
-            else:
-                bkg_corr_i = bkg_corr[i]
-                bkgnorm = 1.
-            for pixel in pixels_in_bin:
-                j, k = pixel[0], pixel[1]
-                if exp_img_data[i][j, k] == 0:
-                    continue
-                exp_val = exp_img_data[i][j, k]
-                exp_val_bkg = exp_img_data[i][j, k] * \
-                              bkg_img_exp / counts_img_exp
-                raw_cts += counts_img_data[i][j, k]
-                bkg_cts += bkg_img_data[i][j, k]
-                exp_raw += exp_val
-                exp_bkg += exp_val_bkg / bkgnorm
-                net_cts += counts_img_data[i][j, k] - bkg_img_data[i][j, k] * bkg_corr_i
+        `pixels_in_bin` is a list of (row, col) pixel coordinates. The
+        background and exposure maps should be the ones returned by
+        get_bkg_exp.
+        """
+        with stage('region.get_bin_vals'):
+            obs_data = get_obs_data(counts_img, bkg_img, exp_img)
+            rows, cols = np.array(pixels_in_bin, dtype=int).reshape(-1, 2).T
+            sums = get_bin_sums(obs_data, rows, cols,
+                                np.zeros(len(rows), dtype=int), 1)
         if only_net_cts:
-            return net_cts
-        raw_rate = raw_cts / exp_raw
-        bkg_rate = bkg_cts / exp_bkg
-        net_rate = raw_rate - bkg_rate
-        err_raw_rate = np.sqrt(raw_cts) / exp_raw
-        err_bkg_rate = np.sqrt(bkg_cts) / exp_bkg
-        err_net_rate = np.sqrt(raw_cts / exp_raw**2 + bkg_cts / exp_bkg**2)
-        return raw_cts, net_cts, bkg_cts, \
-               raw_rate, err_raw_rate, net_rate, err_net_rate, bkg_rate, err_bkg_rate
+            return sums[1][0]
+        return tuple(val[0] for val in get_bin_stats(*sums))
+
+    def get_bins_vals(self, counts_img, bkg_img, exp_img, label_map):
+        """Calculate the counts and rates in all the bins of a region at once.
+
+        `label_map` is an integer array with the same shape as the images
+        that holds the index of the bin each pixel belongs to. Pixels with
+        negative labels are ignored. The pixels of all bins and observations
+        are gathered with fancy indexing and reduced with np.bincount. Only
+        the section of the images that contains labeled pixels is read.
+
+        Returns a tuple of eleven arrays with one entry per bin: the raw,
+        net, and background counts, the raw rate and its uncertainty, the
+        net rate and its uncertainty, the background rate and its
+        uncertainty, and the source and background exposures.
+        """
+        label_map = np.asarray(label_map)
+        rows, cols = np.nonzero(label_map >= 0)
+        labels = label_map[rows, cols]
+        if len(labels):
+            bounds = (rows.min(), rows.max() + 1, cols.min(), cols.max() + 1)
+        else:
+            bounds = (0, 0, 0, 0)
+        counts_img, bkg_img, exp_img = [get_cutout(img, bounds)
+                                        for img in (counts_img, bkg_img,
+                                                    exp_img)]
+        bkg_img, exp_img = get_bkg_exp(counts_img, bkg_img, exp_img)
+        obs_data = get_obs_data(counts_img, bkg_img, exp_img)
+        nbins = labels.max() + 1 if len(labels) else 0
+        sums = get_bin_sums(obs_data, rows - bounds[0], cols - bounds[2],
+                            labels, nbins)
+        return get_bin_stats(*sums) + sums[3:]
+
+    def group_bins(self, net_cts, min_counts):
+        """Group consecutive bins until each group has enough net counts.
+
+        `net_cts` holds the net counts in each of the initial (fine) bins.
+        The bins are merged in a single pass over the running totals. If the
+        outermost group has fewer than `min_counts` net counts, then it is
+        merged into the previous group. Returns a list of (first, last + 1)
+        fine bin indices for each group.
+        """
+        with stage('region.group_bins', bins=len(net_cts)):
+            return self._group_bins(net_cts, min_counts)
+
+    def _group_bins(self, net_cts, min_counts):
+        groups = []
+        first_bin = 0
+        group_cts = 0.
+        for i, bin_cts in enumerate(net_cts):
+            group_cts += bin_cts
+            if group_cts >= min_counts:
+                groups.append((first_bin, i + 1))
+                first_bin = i + 1
+                group_cts = 0.
+        if first_bin < len(net_cts):
+            if len(groups) == 0:
+                error_message = ErrorMessages('001')
+                raise ValueError(error_message)
+            groups[-1] = (groups[-1][0], len(net_cts))
+        return groups
+
+    def fine_bin_sums(self, counts_img, bkg_img, exp_img, islog=True):
+        """Sum the counts and exposures in the initial (fine) bins.
+
+        Only the sections of the source, background, and exposure maps that
+        overlap the bounding box of the region are read, and missing
+        background or exposure maps are only allocated for that section.
+        Returns the bin edges, the (row, col, bin) arrays of the pixels in
+        the region, and the raw, net, and background counts, and the source
+        and background exposures of each fine bin.
+        """
+        shape = counts_img.shape
+        bounds = self.get_bounds(*shape)
+        obs_data = read_obs_data(counts_img, bkg_img, exp_img, bounds)
+        return self.obs_bin_sums(obs_data, bounds, shape, islog)
+
+    def obs_bin_sums(self, obs_data, bounds, shape, islog=True):
+        """Sum the counts and exposures in the initial (fine) bins.
+
+        Same as fine_bin_sums, but for observation data (see read_obs_data)
+        already read from the section of the images given by `bounds`, which
+        should contain the bounding box of the region. `shape` is the shape
+        of the full images.
+        """
+        edges = self.make_edges(islog)
+        rows, cols, fine_bins = self.get_pixels(edges, *shape)
+        sums = get_bin_sums(obs_data, rows - bounds[0], cols - bounds[2],
+                            fine_bins, len(edges) - 1)
+        return edges, (rows, cols, fine_bins), sums
 
     def merge_bins(self, counts_img, bkg_img, exp_img,
                    min_counts, islog=True):
-        bkg_img, exp_img = get_bkg_exp(counts_img, bkg_img, exp_img)
-        edges = self.make_edges(islog)
-        if isinstance(counts_img.data, list):
-            pixels_in_bins = self.distribute_pixels(edges,
-                                                    counts_img.data[0].shape[0],
-                                                    counts_img.data[0].shape[1])
-        else:
-            pixels_in_bins = self.distribute_pixels(edges,
-                                                    counts_img.data.shape[0],
-                                                    counts_img.data.shape[1]) 
-        nbins = len(edges) - 1
-        npix = len(pixels_in_bins)
+        """Merge bins until each bin has at least min_counts net counts.
+
+        The raw, background, and exposure totals of the initial bins are
+        calculated only once, and the bins are then merged based on these
+        totals. Returns a list of tuples of the form (start edge, end edge,
+        list of (row, col) pixels in the bin).
+        """
+        with stage('region.merge_bins'):
+            return self._merge_bins(counts_img, bkg_img, exp_img,
+                                    min_counts, islog)
+
+    def _merge_bins(self, counts_img, bkg_img, exp_img, min_counts, islog):
+        edges, (rows, cols, fine_bins), sums = \
+            self.fine_bin_sums(counts_img, bkg_img, exp_img, islog)
+        groups = self.group_bins(sums[1], min_counts)
+
+        # Keep the pixels of each merged bin ordered by initial bin.
+        order = np.argsort(fine_bins, kind='stable')
+        splits = np.searchsorted(fine_bins[order],
+                                 [first for first, _ in groups[1:]])
+        pixels = list(zip(rows[order].tolist(), cols[order].tolist()))
         bins = []
-        start_edge = edges[0]
-        pixels_in_current_bin = []
-        for i in range(nbins):
-            end_edge = edges[i+1]
-            pixels_in_current_bin.extend(
-                    [(pixels_in_bins[j][0], pixels_in_bins[j][1])
-                      for j in range(npix) if pixels_in_bins[j][2] == i])
-            net_counts = self.get_bin_vals(counts_img, bkg_img, exp_img,
-                             pixels_in_current_bin, only_net_cts=True)
-            if net_counts < min_counts:
-                if end_edge == edges[-1] and len(bins) != 0:
-                    bins[-1][2].extend(pixels_in_current_bin)
-                    updated_last_bin = (bins[-1][0], end_edge, bins[-1][2])
-                    bins[-1] = updated_last_bin
-                elif end_edge == edges[-1] and len(bins) == 0:
-                    error_message = ErrorMessages('001')
-                    raise ValueError(error_message)
-                else:
-                    continue
-            else:
-                bins.append((start_edge, end_edge, pixels_in_current_bin))
-                start_edge = end_edge
-                pixels_in_current_bin = []
+        for (first, last), start, end in zip(groups, [0] + list(splits),
+                                             list(splits) + [len(pixels)]):
+            bins.append((edges[first], edges[last], pixels[start:end]))
         return bins
 
-    def profile(self, counts_img, bkg_img, exp_img, min_counts=50, islog=True):
+    def profile(self, counts_img, bkg_img, exp_img, min_counts=50, islog=True,
+                cache=None):
         """Generate count profiles.
 
         The box is divided into bins based on a minimum number of counts or a
@@ -201,36 +218,75 @@ class Region(object):
                 -ellipse(......)
                 -circle(......)
 
-        The function returns a list of tuples of the form:
-        (bin radius, bin width, source counts, source counts uncertainty,
-        background counts, background counts uncertainty, net counts,
-        net counts uncertainty)
+        The function returns a ProfileTable with one row per bin and the
+        columns (bin radius, bin width, raw counts, net counts, background
+        counts, raw rate, raw rate uncertainty, net rate, net rate
+        uncertainty, background rate, background rate uncertainty, source
+        exposure, background exposure). Iterating over the table yields the
+        rows as tuples, in this order. The uncertainties of the rates assume
+        Gaussian statistics; Poisson bootstrap uncertainties can be added
+        with ProfileTable.bootstrap.
+
+        If `cache` is True, or a ProfileCache, then the profile is looked up
+        in the on-disk profile cache first, and stored there after it is
+        extracted (see ProfileCache). The data of images read into memory
+        are only checksummed the first time: after modifying them in place,
+        call Image.reset_fingerprint() on the image, or the cached profile
+        of the old data is returned.
+
+        If instrumentation is enabled (see pyxel.instrument), the wall time
+        and counters of the extraction stages are attached to the table as
+        `stats`.
         """
-        bkg_img, exp_img = get_bkg_exp(counts_img, bkg_img, exp_img)
-        if isinstance(counts_img.hdr, list):
-            pix2arcmin = counts_img.hdr[0]['CDELT2'] * 60.
-        else:
-            pix2arcmin = counts_img.hdr['CDELT2'] * 60.
-
-        bins = self.merge_bins(counts_img, bkg_img, exp_img,
-                               min_counts, islog)
-
-        profile = []
-        for current_bin in bins:
-            raw_cts, net_cts, bkg_cts, \
-                raw_rate, err_raw_rate, net_rate, err_net_rate, \
-                bkg_rate, err_bkg_rate = \
-                    self.get_bin_vals(counts_img, bkg_img, exp_img,
-                                      current_bin[2])
-            bin_radius = (current_bin[0] + current_bin[1]) / 2.
-            bin_width = current_bin[1] - bin_radius
-            bin_values = (bin_radius, bin_width, raw_cts,
-                          net_cts, bkg_cts,
-                          raw_rate, err_raw_rate, net_rate, err_net_rate,
-                          bkg_rate, err_bkg_rate)
-            bin_values = bin_pix2arcmin(bin_values, pix2arcmin)
-            profile.append(bin_values)
-        return profile
+        with collect() as stats, stage('region.profile'):
+            table = self._profile(counts_img, bkg_img, exp_img, min_counts,
+                                  islog, cache)
+            table.stats = stats
+        return table
+
+    def _profile(self, counts_img, bkg_img, exp_img, min_counts, islog,
+                 cache):
+        cache = get_profile_cache(cache)
+        if cache is not None:
+            key = cache.get_key(self, counts_img, bkg_img, exp_img,
+                                min_counts, islog)
+            with stage('profile_cache.get') as st:
+                entry = cache.get(key)
+                st.count(hits=int(entry is not None))
+            if entry is not None:
+                return entry[0]
+
+        edges, (rows, cols, fine_bins), sums = \
+            self.fine_bin_sums(counts_img, bkg_img, exp_img, islog)
+        table = self.profile_from_sums(edges, sums, min_counts,
+                                       get_pix2arcmin(counts_img))
+        if cache is not None:
+            first_bins = [first for first, _ in
+                          self.group_bins(sums[1], min_counts)]
+            bins = np.searchsorted(first_bins, fine_bins, side='right') - 1
+            cache.put(key, table, rows * counts_img.shape[1] + cols, bins)
+        return table
+
+    def profile_from_sums(self, edges, sums, min_counts, pix2arcmin):
+        """Merge the initial (fine) bins into a profile.
+
+        `edges` and `sums` are the bin edges and the sums returned by
+        fine_bin_sums. The bins are grouped until they have at least
+        min_counts net counts, and the radii are converted to arcmin.
+        """
+        groups = self.group_bins(sums[1], min_counts)
+
+        # The counts and exposures are additive, so the totals of the merged
+        # bins follow directly from the totals of the initial bins.
+        first_bins = [first for first, _ in groups]
+        bin_sums = [np.add.reduceat(vals, first_bins) for vals in sums]
+        bin_start = np.array([edges[first] for first, _ in groups])
+        bin_end = np.array([edges[last] for _, last in groups])
+        bin_radius = (bin_start + bin_end) / 2.
+        bin_width = bin_end - bin_radius
+        bin_values = bin_pix2arcmin((bin_radius, bin_width) +
+                                    get_bin_stats(*bin_sums), pix2arcmin)
+        return ProfileTable.from_columns(bin_values)
 
     def counts_profile(self, counts_img, bkg_img, bkg_err_img, exp_img,
         min_counts=100, islog=True):
@@ -256,15 +312,15 @@ class Region(object):
         this routine, by just calling count_profile to get the data. This would
         allow for more customization than this routine provides.
         """
-        nbins = len(profile)
+        profile = ProfileTable.from_rows(profile)
 
-        r = np.array([profile[i][0] for i in range(nbins)])
-        r_err = np.array([profile[i][1] for i in range(nbins)])
+        r = profile['r']
+        r_err = profile['r_err']
 
-        bkg = np.array([profile[i][5] for i in range(nbins)])
-        bkg_err = np.array([profile[i][6] for i in range(nbins)])
-        net_cts = np.array([profile[i][7] for i in range(nbins)])
-        err_net_cts = np.array([profile[i][8] for i in range(nbins)])
+        bkg = profile['raw_rate']
+        bkg_err = profile['raw_rate_err']
+        net_cts = profile['net_rate']
+        err_net_cts = profile['net_rate_err']
 
         plt.scatter(r, net_cts, c="#1e8f1e", alpha=0.85, s=35, marker="s")
         plt.errorbar(r, net_cts, xerr=r_err, yerr=err_net_cts,
@@ -305,3 +361,72 @@ class Region(object):
                 plt.plot(r, evaluated_model, color="#ffa500", linewidth=2, alpha=0.75)
 
         plt.show()
+
+def profiles(regions, counts_img, bkg_img, exp_img, min_counts=50,
+             islog=True):
+    """Generate the count profiles of several regions at once.
+
+    The regions are grouped with their neighbors (see group_regions), and
+    the section of the source, background, and exposure maps that covers
+    each group is read and prepared only once. The profiles of the regions
+    of a group are then extracted from it, so overlapping regions share the
+    reads, while distant regions do not read the pixels between them. The
+    profiles are the same as those
+    returned by Region.profile, which describes the arguments. Returns a
+    list with the ProfileTable of each region. If instrumentation is
+    enabled, all the tables share the stats of the extraction.
+    """
+    with collect() as stats, stage('profiles', regions=len(regions)):
+        tables = _profiles(regions, counts_img, bkg_img, exp_img,
+                           min_counts, islog)
+    for table in tables:
+        table.stats = stats
+    return tables
+
+def _bounds_area(bounds):
+    return (bounds[1] - bounds[0]) * (bounds[3] - bounds[2])
+
+def _union_bounds(bounds1, bounds2):
+    return (min(bounds1[0], bounds2[0]), max(bounds1[1], bounds2[1]),
+            min(bounds1[2], bounds2[2]), max(bounds1[3], bounds2[3]))
+
+def group_regions(all_bounds, max_ratio=GROUP_AREA_RATIO):
+    """Group regions whose sections can be read together.
+
+    `all_bounds` holds the (row_min, row_max, col_min, col_max) bounds of
+    each region. Starting with the largest, each region joins the first
+    group for which the section covering the group and the region is at
+    most `max_ratio` times the summed areas of their own sections, or
+    starts a new group. Returns a list of (bounds, region indices) tuples.
+    """
+    groups = []
+    order = sorted(range(len(all_bounds)),
+                   key=lambda i: -_bounds_area(all_bounds[i]))
+    for i in order:
+        bounds = tuple(int(b) for b in all_bounds[i])
+        area = _bounds_area(bounds)
+        for group in groups:
+            union = _union_bounds(group['bounds'], bounds)
+            if _bounds_area(union) <= max_ratio * (group['area'] + area):
+                group['bounds'] = union
+                group['area'] += area
+                group['indices'].append(i)
+                break
+        else:
+            groups.append({'bounds': bounds, 'area': area, 'indices': [i]})
+    return [(group['bounds'], sorted(group['indices'])) for group in groups]
+
+def _profiles(regions, counts_img, bkg_img, exp_img, min_counts, islog):
+    shape = counts_img.shape
+    all_bounds = [region.get_bounds(*shape) for region in regions]
+    pix2arcmin = get_pix2arcmin(counts_img)
+
+    tables = [None] * len(regions)
+    for bounds, indices in group_regions(all_bounds):
+        obs_data = read_obs_data(counts_img, bkg_img, exp_img, bounds)
+        for i in indices:
+            edges, _, sums = regions[i].obs_bin_sums(obs_data, bounds, shape,
+                                                     islog)
+            tables[i] = regions[i].profile_from_sums(edges, sums, min_counts,
+                                                     pix2arcmin)
+    return tables
@@ -0,0 +1,389 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.integrate
+import scipy.interpolate
+import scipy.special
+
+from .cache import hash_key, save_npz
+
+# Version of the table format. Tables saved with a different version are
+# regenerated.
+TABLE_VERSION = 1
+
+DEFAULT_TABLE_DIR = os.path.join(os.path.expanduser('~'), '.pyxel')
+
+# Default grids as (start, stop, num) tuples. The inner integral is
+# tabulated in log10(x / rbreak), and the outer integral in
+# sqrt(1 - (x / rbreak)**2), the lower limit of the outer integral, in which
+# it is smooth up to the break. The outer integral to infinity only converges
+# for index > 1/2, so it is only tabulated for indices above 0.55.
+LOG_U_GRID = (-3., 0., 121)
+INNER_INDEX_GRID = (-3., 4., 141)
+OUTER_LIMIT_GRID = (0., 1., 101)
+OUTER_INDEX_GRID = (0.55, 4., 70)
+
+# The finite line-of-sight limits are applied as series corrections, which
+# are accurate for z_min / x below this ratio.
+MAX_ZMIN_RATIO = 0.1
+
+_active_table = None
+
+def _grid(spec):
+    start, stop, num = spec
+    return np.linspace(start, stop, num)
+
+def _inner_column(args):
+    """Tabulate the inner integral for one index.
+
+    For u = x / rbreak, the inner integral is the integral of
+    (u**2 + s**2)**(-index) for s from 0 to sqrt(1 - u**2). The table holds
+    the log of its mean value over the interval, and the derivative of that
+    log with respect to the index.
+    """
+    index, log_u = args
+    vals = np.zeros(len(log_u))
+    derivs = np.zeros(len(log_u))
+    for i, u in enumerate(10**log_u):
+        a = np.sqrt(max(1. - u**2, 0.))
+        if a == 0.:
+            # At u = 1 the interval is empty, and the mean value tends to
+            # u**(-2 * index) = 1.
+            continue
+        f = lambda s: (u**2 + s**2)**(-index)
+        g = lambda s: -np.log(u**2 + s**2) * (u**2 + s**2)**(-index)
+        integral = scipy.integrate.quad(f, 0., a, points=[min(u, a / 2.)],
+                                        epsabs=0., epsrel=1e-12,
+                                        limit=200)[0]
+        deriv = scipy.integrate.quad(g, 0., a, points=[min(u, a / 2.)],
+                                     epsabs=0., epsrel=1e-12, limit=200)[0]
+        vals[i] = np.log(integral / a)
+        derivs[i] = deriv / integral
+    return vals, derivs
+
+def _outer_column(args):
+    """Tabulate the outer integral for one index.
+
+    For u = x / rbreak <= 1, the outer integral is the integral of
+    (u**2 + s**2)**(-index) for s from a = sqrt(1 - u**2) to infinity. The
+    columns are computed for a grid of a rather than u. The part
+    above s = 1 is integrated in t = 1 / s, where the integrand has an
+    algebraic singularity at t = 0 that quad handles with its weights. The
+    integral has a pole at index = 1/2, so the table holds the log of the
+    integral times (2 * index - 1), and the derivative of that log with
+    respect to the index.
+    """
+    index, limits = args
+    vals = np.zeros(len(limits))
+    derivs = np.zeros(len(limits))
+    for i, a in enumerate(limits):
+        u = np.sqrt(max(1. - a**2, 0.))
+        f = lambda s: (u**2 + s**2)**(-index)
+        g = lambda s: -np.log(u**2 + s**2) * (u**2 + s**2)**(-index)
+        h = lambda t: (1. + u**2 * t**2)**(-index)
+        quad_kwargs = dict(epsabs=0., epsrel=1e-12, limit=200)
+        weight = dict(weight='alg', wvar=(2. * index - 2., 0.))
+        log_weight = dict(weight='alg-loga', wvar=(2. * index - 2., 0.))
+        integral = scipy.integrate.quad(f, a, 1., **quad_kwargs)[0] + \
+                   scipy.integrate.quad(h, 0., 1., **weight)[0]
+        deriv = scipy.integrate.quad(g, a, 1., **quad_kwargs)[0] + \
+                scipy.integrate.quad(lambda t: -np.log(1. + u**2 * t**2) *
+                                     h(t), 0., 1., **weight)[0] + \
+                2. * scipy.integrate.quad(h, 0., 1., **log_weight)[0]
+        vals[i] = np.log((2. * index - 1.) * integral)
+        derivs[i] = deriv / integral + 2. / (2. * index - 1.)
+    return vals, derivs
+
+def _tabulate(column_fn, indices, abscissae, workers):
+    args = [(index, abscissae) for index in indices]
+    if workers == 1:
+        columns = [column_fn(arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            columns = list(executor.map(column_fn, args))
+    vals = np.array([col[0] for col in columns]).T
+    derivs = np.array([col[1] for col in columns]).T
+    return vals, derivs
+
+def _midpoints(grid):
+    return (grid[1:] + grid[:-1]) / 2.
+
+class _IndexSlice(object):
+    """Evaluate a bicubic spline at many abscissae and a single index.
+
+    The spline is reduced to a 1-D spline in the abscissa, by contracting
+    its coefficients with the B-spline basis at the index. This is several
+    times faster than evaluating the bicubic spline at each point.
+    """
+    def __init__(self, spline):
+        tx, ty = spline.get_knots()
+        kx, ky = spline.degrees
+        self._knots = tx
+        self._degree = kx
+        self._coeffs = spline.get_coeffs().reshape(len(tx) - kx - 1,
+                                                   len(ty) - ky - 1)
+        self._index_knots = ty
+        self._index_degree = ky
+
+    def _basis(self, index):
+        """Return the first B-spline of the index that is nonzero at
+        `index`, and the values of the nonzero B-splines (Cox-de Boor)."""
+        t, k = self._index_knots, self._index_degree
+        i = min(max(int(np.searchsorted(t, index, 'right')) - 1, k),
+                len(t) - k - 2)
+        left = [index - t[i + 1 - j] for j in range(k + 1)]
+        right = [t[i + j] - index for j in range(k + 1)]
+        vals = [1.] + [0.] * k
+        for j in range(1, k + 1):
+            saved = 0.
+            for r in range(j):
+                tmp = vals[r] / (right[r + 1] + left[j - r])
+                vals[r] = saved + right[r + 1] * tmp
+                saved = left[j - r] * tmp
+            vals[j] = saved
+        return i - k, vals
+
+    def __call__(self, x, index):
+        first, vals = self._basis(index)
+        coeffs = self._coeffs[:, first:first + len(vals)].dot(vals)
+        # The knots were validated when the table was built.
+        return scipy.interpolate.BSpline.construct_fast(
+            self._knots, coeffs, self._degree)(x)
+
+class ProjectionTable(object):
+    """Interpolation tables of the projected power-law integrals.
+
+    BrokenPow integrates ((x**2 + z**2) / rbreak**2)**(-index) along the
+    line of sight, inside and outside the break. With u = x / rbreak and
+    s = z / rbreak, both integrals are rbreak times dimensionless integrals
+    that only depend on (u, index), up to small corrections for the finite
+    line-of-sight limits. These dimensionless integrals and their index
+    derivatives are tabulated on grids of (log10 u, index) inside the break
+    and of (sqrt(1 - u**2), index) outside it, and interpolated with bicubic
+    splines. For u > 1 the outer integral is known in closed form and is not
+    tabulated.
+
+    `error_bound` is the largest relative error of the interpolated values
+    and derivatives, measured at the centers of the grid cells when the
+    table is generated.
+    """
+    def __init__(self, log_u, inner_index, outer_limit, outer_index,
+                 inner_vals, inner_derivs, outer_vals, outer_derivs,
+                 error_bound):
+        self.log_u = log_u
+        self.inner_index = inner_index
+        self.outer_limit = outer_limit
+        self.outer_index = outer_index
+        self.inner_vals = inner_vals
+        self.inner_derivs = inner_derivs
+        self.outer_vals = outer_vals
+        self.outer_derivs = outer_derivs
+        self.error_bound = error_bound
+        spline = scipy.interpolate.RectBivariateSpline
+        self._inner = spline(log_u, inner_index, inner_vals)
+        self._inner_deriv = spline(log_u, inner_index, inner_derivs)
+        self._outer = spline(outer_limit, outer_index, outer_vals)
+        self._outer_deriv = spline(outer_limit, outer_index, outer_derivs)
+        self._inner_slice = _IndexSlice(self._inner)
+        self._inner_deriv_slice = _IndexSlice(self._inner_deriv)
+        self._outer_slice = _IndexSlice(self._outer)
+        self._outer_deriv_slice = _IndexSlice(self._outer_deriv)
+
+    @classmethod
+    def generate(cls, log_u_grid=LOG_U_GRID, inner_index_grid=INNER_INDEX_GRID,
+                 outer_limit_grid=OUTER_LIMIT_GRID,
+                 outer_index_grid=OUTER_INDEX_GRID, workers=None):
+        """Compute the tables by numerical quadrature.
+
+        The grid columns (one per index) are computed in parallel by
+        `workers` processes; `workers=1` computes them serially.
+        """
+        log_u = _grid(log_u_grid)
+        inner_index = _grid(inner_index_grid)
+        outer_limit = _grid(outer_limit_grid)
+        outer_index = _grid(outer_index_grid)
+        inner_vals, inner_derivs = _tabulate(_inner_column, inner_index,
+                                             log_u, workers)
+        outer_vals, outer_derivs = _tabulate(_outer_column, outer_index,
+                                             outer_limit, workers)
+        table = cls(log_u, inner_index, outer_limit, outer_index, inner_vals,
+                    inner_derivs, outer_vals, outer_derivs, np.nan)
+        table.error_bound = table.measure_error(workers)
+        return table
+
+    def measure_error(self, workers=None):
+        """Return the largest relative interpolation error at the centers
+        of the grid cells."""
+        errors = []
+        for column_fn, abscissae, index, spline, spline_deriv in (
+                (_inner_column, _midpoints(self.log_u),
+                 _midpoints(self.inner_index), self._inner,
+                 self._inner_deriv),
+                (_outer_column, _midpoints(self.outer_limit),
+                 _midpoints(self.outer_index), self._outer,
+                 self._outer_deriv)):
+            vals, derivs = _tabulate(column_fn, index, abscissae, workers)
+            interp_vals = spline(abscissae, index)
+            interp_derivs = spline_deriv(abscissae, index)
+            # The tables hold logs, so absolute errors of the values are
+            # relative errors of the integrals.
+            errors.append(np.max(np.abs(np.expm1(interp_vals - vals))))
+            errors.append(np.max(np.abs(interp_derivs - derivs) /
+                                 np.maximum(np.abs(derivs), 1.)))
+        return max(errors)
+
+    def save(self, filename):
+        save_npz(filename, version=TABLE_VERSION, log_u=self.log_u,
+                 inner_index=self.inner_index, outer_limit=self.outer_limit,
+                 outer_index=self.outer_index,
+                 inner_vals=self.inner_vals, inner_derivs=self.inner_derivs,
+                 outer_vals=self.outer_vals, outer_derivs=self.outer_derivs,
+                 error_bound=self.error_bound)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            if f['version'] != TABLE_VERSION:
+                raise ValueError('%s was saved with a different version of '
+                                 'the table format.' % filename)
+            return cls(f['log_u'], f['inner_index'], f['outer_limit'],
+                       f['outer_index'], f['inner_vals'], f['inner_derivs'], f['outer_vals'],
+                       f['outer_derivs'], float(f['error_bound']))
+
+    def covers(self, x, rbreak, ind1, ind2, z_min):
+        """Check if the tables can be used for these radii and parameters."""
+        x_min = np.min(x)
+        u_min = x_min / rbreak
+        return bool(self.inner_index[0] <= ind1 <= self.inner_index[-1] and
+                    self.outer_index[0] <= ind2 <= self.outer_index[-1] and
+                    x_min * MAX_ZMIN_RATIO >= z_min and
+                    (u_min > 1. or u_min >= 10**self.log_u[0]))
+
+    def integrals(self, x, rbreak, ind1, ind2, z_min, z_max,
+                  with_derivs=True):
+        """Return the line-of-sight integrals inside and outside the break
+        and their derivatives with respect to the indices.
+
+        The arguments are the same as for projected_power_law, and the
+        returned arrays correspond to tmp1, tmp2, d(tmp1)/d(ind1), and
+        d(tmp2)/d(ind2) in BrokenPow. The derivatives are None if
+        `with_derivs` is False. The tables should cover the arguments (see
+        covers).
+        """
+        x = np.asarray(x, dtype=float)
+        # Models pass the parameters as arrays of one element.
+        ind1 = np.asarray(ind1).item()
+        ind2 = np.asarray(ind2).item()
+        u = x / rbreak
+        inner = u <= 1.
+        log_u = np.log10(np.where(inner, u, 1.))
+        eps = z_min / rbreak
+        big = z_max / rbreak
+
+        # Inside the break: the mean value over the interval times its
+        # length, minus the part below z_min.
+        length = np.sqrt(np.where(inner, 1. - u**2, 0.))
+        mean = np.exp(self._inner_slice(log_u, ind1))
+        low1, d_low1 = _lower_correction(u, ind1, eps, with_derivs)
+        tmp1 = np.where(inner, length * mean - low1, 0.)
+
+        # Outside the break: from the tables inside the break, and in
+        # closed form outside it.
+        outer = np.exp(self._outer_slice(length, ind2)) / (2. * ind2 - 1.)
+        log_norm = np.log(np.sqrt(np.pi) / 2.) + \
+                   scipy.special.gammaln(ind2 - 0.5) - \
+                   scipy.special.gammaln(ind2)
+        full = np.exp(log_norm + (1. - 2. * ind2) * np.log(u))
+        low2, d_low2 = _lower_correction(u, ind2, eps, with_derivs)
+        high2, d_high2 = _upper_correction(u, ind2, big, with_derivs)
+        tmp2 = np.where(inner, outer, full - low2) - high2
+        if not with_derivs:
+            return rbreak * tmp1, rbreak * tmp2, None, None
+
+        d_mean = mean * self._inner_deriv_slice(log_u, ind1)
+        d_tmp1 = np.where(inner, length * d_mean - d_low1, 0.)
+        d_outer = outer * (self._outer_deriv_slice(length, ind2) -
+                           2. / (2. * ind2 - 1.))
+        d_log_norm = scipy.special.digamma(ind2 - 0.5) - \
+                     scipy.special.digamma(ind2)
+        d_full = full * (d_log_norm - 2. * np.log(u))
+        d_tmp2 = np.where(inner, d_outer, d_full - d_low2) - d_high2
+        return (rbreak * tmp1, rbreak * tmp2,
+                rbreak * d_tmp1, rbreak * d_tmp2)
+
+def _lower_correction(u, index, eps, with_derivs=True):
+    """Integral of (u**2 + s**2)**(-index) for s from 0 to eps << u, and its
+    index derivative (None if `with_derivs` is False), from the series
+    expansion in (eps / u)**2."""
+    r2 = (eps / u)**2
+    scale = eps * u**(-2. * index)
+    val = scale * (1. - index * r2 / 3. + index * (index + 1.) * r2**2 / 10.)
+    if not with_derivs:
+        return val, None
+    deriv = -2. * np.log(u) * val + \
+            scale * (-r2 / 3. + (2. * index + 1.) * r2**2 / 10.)
+    return val, deriv
+
+def _upper_correction(u, index, big, with_derivs=True):
+    """Integral of (u**2 + s**2)**(-index) for s from big >> u to infinity,
+    and its index derivative (None if `with_derivs` is False), from the
+    series expansion in (u / big)**2."""
+    q = (u / big)**2
+    scale = big**(1. - 2. * index)
+    series = 1. / (2. * index - 1.) - index * q / (2. * index + 1.)
+    if not with_derivs:
+        return scale * series, None
+    d_series = -2. / (2. * index - 1.)**2 - q / (2. * index + 1.)**2
+    val = scale * series
+    deriv = -2. * np.log(big) * val + scale * d_series
+    return val, deriv
+
+def table_filename(table_dir=None, log_u_grid=LOG_U_GRID,
+                   inner_index_grid=INNER_INDEX_GRID,
+                   outer_limit_grid=OUTER_LIMIT_GRID,
+                   outer_index_grid=OUTER_INDEX_GRID):
+    """Return the file name under which a table with this grid is saved."""
+    if table_dir is None:
+        table_dir = DEFAULT_TABLE_DIR
+    key = (TABLE_VERSION, tuple(log_u_grid), tuple(inner_index_grid),
+           tuple(outer_limit_grid), tuple(outer_index_grid))
+    return os.path.join(table_dir, 'projection-%s.npz' % hash_key(key))
+
+def enable_projection_table(table_dir=None, workers=None, **grids):
+    """Use the interpolation tables in BrokenPow.
+
+    The tables are loaded from `table_dir` (default: ~/.pyxel). If they do
+    not exist yet, they are generated with `workers` processes and saved
+    there, so this is only slow the first time. `grids` can override the
+    default grids as (start, stop, num) tuples, passed as log_u_grid,
+    inner_index_grid, outer_limit_grid, and outer_index_grid.
+    BrokenPow falls back to the closed form for parameters outside the
+    tables, and for values alone at few radii, where the closed form is
+    faster (see models.TABLE_MIN_POINTS). Returns the table.
+    """
+    global _active_table
+    filename = table_filename(table_dir, **grids)
+    if os.path.isfile(filename):
+        table = ProjectionTable.load(filename)
+    else:
+        table = ProjectionTable.generate(workers=workers, **grids)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        table.save(filename)
+    _active_table = table
+    return table
+
+def disable_projection_table():
+    """Go back to evaluating BrokenPow with the closed form."""
+    global _active_table
+    _active_table = None
+
+def get_projection_table():
+    """Return the table used by BrokenPow, or None if it is disabled."""
+    return _active_table
+
+def set_projection_table(table):
+    """Use `table` in BrokenPow, e.g. one returned by
+    enable_projection_table, or go back to the closed form if it is None."""
+    global _active_table
+    _active_table = table
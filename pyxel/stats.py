@@ -1,17 +1,50 @@
 import numpy as np
 
+def model_vals_and_derivs(updated_model, x):
+    """
+    Evaluates a model and its derivatives with respect to the parameters.
+
+    Models that define evaluate_with_derivatives compute both in one pass;
+    for the others, the model and fit_deriv are called separately.
+    """
+    if hasattr(updated_model, 'evaluate_with_derivatives'):
+        model_vals, model_derivs = updated_model.evaluate_with_derivatives(
+            x, *updated_model.parameters)
+    else:
+        model_vals = updated_model(x)
+        model_derivs = updated_model.fit_deriv(x, *updated_model.parameters)
+    return model_vals, np.array(model_derivs)
+
 def cstat_deriv(measured_raw_cts, updated_model, measured_bkg_cts,
                       t_raw, t_bkg, x):
     """
     Calculates the derivatives of the C-statistic.
     """
-    model_derivs = np.array(updated_model.fit_deriv(x, *updated_model.parameters))
-    model_vals = updated_model(x)
+    model_vals, model_derivs = model_vals_and_derivs(updated_model, x)
+    return cstat_deriv_from_vals(measured_raw_cts, model_vals, model_derivs,
+                                 measured_bkg_cts, t_raw, t_bkg)
 
-    nbins = len(model_vals)
-    nparams = len(updated_model.parameters)
-    d_cash = np.zeros(nparams)
+def cstat_with_deriv(measured_raw_cts, updated_model, measured_bkg_cts,
+                     t_raw, t_bkg, x):
+    """
+    Calculates the C-statistic and its derivatives from a single evaluation
+    of the model and its derivatives.
+    """
+    model_vals, model_derivs = model_vals_and_derivs(updated_model, x)
+    return (cstat_from_vals(measured_raw_cts, model_vals, measured_bkg_cts,
+                            t_raw, t_bkg),
+            cstat_deriv_from_vals(measured_raw_cts, model_vals, model_derivs,
+                                  measured_bkg_cts, t_raw, t_bkg))
+
+def cstat_deriv_from_vals(measured_raw_cts, model_vals, model_derivs,
+                          measured_bkg_cts, t_raw, t_bkg):
+    """
+    Calculates the derivatives of the C-statistic from the model values and
+    the model derivatives (one row per parameter).
 
+    The three cases (no source counts, no background counts, and the general
+    case) are evaluated for all bins at once and selected with masks.
+    """
     # Some of these calculations are used often, so they are done only once
     # here to speed up the code.
     tmp1 = t_raw + t_bkg
@@ -23,29 +56,27 @@ def cstat_deriv(measured_raw_cts, updated_model, measured_bkg_cts,
     tmp7 = t_raw * model_derivs
     tmp8 = t_bkg * model_derivs
 
-    d = (tmp3 ** 2 + 4. * tmp4)**0.5
-    f = (-tmp3 + d) / (2. * tmp1)
-
-    d_d = (tmp3 ** 2 + 4. * tmp4)**-0.5 * (2. * tmp6 + tmp3 * tmp5)
-    d_f = -0.5 * model_derivs + d_d / (2. * tmp1)
-
-    for i in range(nbins):
-        if measured_raw_cts[i] == 0 and measured_bkg_cts[i] > 0:
-            d_cash += tmp7[:,i]
-        elif measured_bkg_cts[i] == 0 and measured_raw_cts[i] > 0:
-            if tmp2[i] < measured_raw_cts[i]:
-                d_cash -= tmp8[:,i]
-            else:
-                d_cash += tmp7[:,i] - \
-                          measured_raw_cts[i] * 1. / model_vals[i] * \
-                          model_derivs[:,i]
-        else:
-            d_cash += tmp7[:,i] + tmp1[i] * d_f[:,i] - \
-                      measured_raw_cts[i] * \
-                      1. / (model_vals[i] + f[i]) * \
-                      (model_derivs[:,i] + d_f[:,i]) - \
-                      measured_bkg_cts[i] * 1. / f[i] * d_f[:,i]
-    return 2. * d_cash
+    no_raw = (measured_raw_cts == 0) & (measured_bkg_cts > 0)
+    no_bkg = (measured_bkg_cts == 0) & (measured_raw_cts > 0)
+    low_model = no_bkg & (tmp2 < measured_raw_cts)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = (tmp3 ** 2 + 4. * tmp4)**0.5
+        f = (-tmp3 + d) / (2. * tmp1)
+
+        d_d = (tmp3 ** 2 + 4. * tmp4)**-0.5 * (2. * tmp6 + tmp3 * tmp5)
+        d_f = -0.5 * model_derivs + d_d / (2. * tmp1)
+
+        d_cash = np.where(no_raw, tmp7,
+                 np.where(low_model, -tmp8,
+                 np.where(no_bkg,
+                          tmp7 - measured_raw_cts * 1. / model_vals *
+                          model_derivs,
+                          tmp7 + tmp1 * d_f -
+                          measured_raw_cts * 1. / (model_vals + f) *
+                          (model_derivs + d_f) -
+                          measured_bkg_cts * 1. / f * d_f)))
+    return 2. * np.sum(d_cash, axis=-1)
 
 def cstat(measured_raw_cts, updated_model, measured_bkg_cts, t_raw, t_bkg, x):
     """
@@ -60,7 +91,19 @@ def cstat(measured_raw_cts, updated_model, measured_bkg_cts, t_raw, t_bkg, x):
            in X-ray astronomy using maximum likelihood", ApJ, 230, p. 274-287
     """
     model_vals = updated_model(x)
+    return cstat_from_vals(measured_raw_cts, model_vals, measured_bkg_cts,
+                           t_raw, t_bkg)
 
+def cstat_from_vals(measured_raw_cts, model_vals, measured_bkg_cts,
+                    t_raw, t_bkg):
+    """
+    C-statistic calculated from precomputed model values.
+
+    The three cases (no source counts, no background counts, and the general
+    case) are evaluated for all bins at once and selected with masks. The
+    statistic is summed over the last axis of `model_vals`, so several sets
+    of model values can be passed as a 2D array (one row per set).
+    """
     # Some of these calculations are used often, so they are done only once
     # here to speed up the code.
     tmp1 = t_raw + t_bkg
@@ -70,24 +113,24 @@ def cstat(measured_raw_cts, updated_model, measured_bkg_cts, t_raw, t_bkg, x):
     tmp5 = t_raw * model_vals
     tmp6 = t_bkg * model_vals
 
-    d = (tmp3 ** 2 + 4. * tmp4)**0.5
-    f = (-tmp3 + d) / (2. * tmp1)
-
-    nbins = len(model_vals)
-    cash = 0.
-    for i in range(nbins):
-        if measured_raw_cts[i] == 0 and measured_bkg_cts[i] > 0:
-            cash += tmp5[i] - measured_bkg_cts[i] * np.log(t_bkg[i] / tmp1[i])
-        elif measured_bkg_cts[i] == 0 and measured_raw_cts[i] > 0:
-            if tmp2[i] < measured_raw_cts[i]:
-                cash -= tmp6[i] + measured_raw_cts[i] * np.log(t_raw[i] / tmp1[i])
-            else:
-                cash += tmp5[i] + measured_raw_cts[i] * \
-                        (np.log(measured_raw_cts[i]/tmp5[i]) - 1)
-        else:
-            cash += tmp5[i] + tmp1[i] * f[i] - \
-                    measured_raw_cts[i] * np.log(t_raw[i] * (model_vals[i] + f[i])) \
-                    - measured_bkg_cts[i] * np.log(t_bkg[i] * f[i]) - \
-                    measured_raw_cts[i] * (1 - np.log(measured_raw_cts[i])) - \
-                    measured_bkg_cts[i] * (1 - np.log(measured_bkg_cts[i]))
-    return 2. * cash
+    no_raw = (measured_raw_cts == 0) & (measured_bkg_cts > 0)
+    no_bkg = (measured_bkg_cts == 0) & (measured_raw_cts > 0)
+    low_model = no_bkg & (tmp2 < measured_raw_cts)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = (tmp3 ** 2 + 4. * tmp4)**0.5
+        f = (-tmp3 + d) / (2. * tmp1)
+
+        cash = np.where(no_raw,
+                        tmp5 - measured_bkg_cts * np.log(t_bkg / tmp1),
+               np.where(low_model,
+                        -(tmp6 + measured_raw_cts * np.log(t_raw / tmp1)),
+               np.where(no_bkg,
+                        tmp5 + measured_raw_cts *
+                        (np.log(measured_raw_cts / tmp5) - 1),
+                        tmp5 + tmp1 * f -
+                        measured_raw_cts * np.log(t_raw * (model_vals + f)) -
+                        measured_bkg_cts * np.log(t_bkg * f) -
+                        measured_raw_cts * (1 - np.log(measured_raw_cts)) -
+                        measured_bkg_cts * (1 - np.log(measured_bkg_cts)))))
+    return 2. * np.sum(cash, axis=-1)
@@ -0,0 +1,29 @@
+import numpy as np
+
+from .epanda import EllipticalGrid
+
+def sweep_angles(nsectors, start_angle=0., end_angle=2 * np.pi):
+    """Split the angles between start_angle and end_angle (in radians) into
+    nsectors contiguous sectors. Returns a list of (start, end) angles."""
+    angles = np.linspace(start_angle, end_angle, nsectors + 1)
+    return list(zip(angles[:-1], angles[1:]))
+
+def sector_profiles(counts_img, bkg_img, exp_img, x0, y0, major_axis,
+                    minor_axis, rot_angle, sectors, min_counts=50,
+                    islog=True):
+    """Generate the count profiles of many elliptical sectors with a common
+    origin.
+
+    The origin, axes, and rotation angle are those of Epanda (0-based pixel
+    coordinates and radians), and `sectors` is a list of (start angle, end
+    angle) tuples, e.g. from sweep_angles. The polar angles and elliptical
+    radii of the pixels are calculated only once (see EllipticalGrid), and
+    the counts and exposures of all the sectors are summed at once, with
+    combined (sector, annulus) labels. The profiles are then grouped
+    separately, so each one is the same as the profile of the corresponding
+    Epanda. Returns a list with the ProfileTable of each sector.
+    """
+    grid = EllipticalGrid(x0, y0, major_axis, minor_axis, rot_angle,
+                          counts_img.shape)
+    grid.load_data(counts_img, bkg_img, exp_img)
+    return grid.sector_profiles(sectors, min_counts, islog)
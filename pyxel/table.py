@@ -0,0 +1,150 @@
+import numpy as np
+from numpy.lib import recfunctions
+
+PROFILE_COLUMNS = ('r', 'r_err', 'raw_cts', 'net_cts', 'bkg_cts',
+                   'raw_rate', 'raw_rate_err', 'net_rate', 'net_rate_err',
+                   'bkg_rate', 'bkg_rate_err', 't_raw', 't_bkg')
+
+BOOTSTRAP_RATES = ('raw_rate', 'net_rate', 'bkg_rate')
+
+class ProfileTable(object):
+    """Column-oriented surface brightness profile.
+
+    The profile is stored as a NumPy structured array with one row per bin
+    and the columns listed in PROFILE_COLUMNS: bin radius, bin half-width,
+    raw, net, and background counts, raw, net, and background rates and
+    their uncertainties, and the source and background exposure time
+    equivalents. Columns are returned as views, e.g. `table['net_rate']`.
+
+    For compatibility with profiles stored as lists of tuples, iterating
+    over the table or indexing it with an integer returns the rows as
+    tuples, in the same order as the columns.
+
+    Tables returned by bootstrap have extra columns with the bootstrap
+    uncertainties, after the ones in PROFILE_COLUMNS.
+    """
+    def __init__(self, data):
+        self.data = data
+        # Stage timings and counters of the extraction (see
+        # pyxel.instrument), if instrumentation was enabled.
+        self.stats = None
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Make a table from a sequence of arrays, one per column."""
+        columns = [np.asarray(col, dtype=float) for col in columns]
+        nrows = len(columns[0]) if columns else 0
+        data = np.empty(nrows, dtype=[(name, float)
+                                      for name in PROFILE_COLUMNS])
+        for name, col in zip(PROFILE_COLUMNS, columns):
+            data[name] = col
+        return cls(data)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Make a table from a list of tuples, as returned by the previous
+        versions of Region.profile."""
+        if isinstance(rows, cls):
+            return rows
+        columns = np.array(rows, dtype=float).reshape(-1,
+                                                      len(PROFILE_COLUMNS))
+        return cls.from_columns(columns.T)
+
+    @property
+    def colnames(self):
+        return self.data.dtype.names
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data.tolist())
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.data[item]
+        elif isinstance(item, (int, np.integer)):
+            return self.data[item].item()
+        else:
+            return self.__class__(self.data[item])
+
+    def __array__(self, dtype=None, copy=None):
+        return recfunctions.structured_to_unstructured(self.data, dtype=dtype)
+
+    def __repr__(self):
+        return '<ProfileTable with %d bins>' % len(self)
+
+    def select(self, minrange, maxrange):
+        """Return the bins with minrange <= r <= maxrange.
+
+        The bins are selected with a single boolean mask. Because the bins
+        are sorted by radius, the selection is normally a contiguous slice,
+        in which case the returned table is a view into this one.
+        """
+        r = self.data['r']
+        idx = np.flatnonzero((minrange <= r) & (r <= maxrange))
+        if len(idx) == 0:
+            return self.__class__(self.data[:0])
+        elif idx[-1] - idx[0] + 1 == len(idx):
+            return self.__class__(self.data[idx[0]:idx[-1] + 1])
+        else:
+            return self.__class__(self.data[idx])
+
+    def with_columns(self, columns):
+        """Return a copy of the table with extra columns, given as a list of
+        (name, array) tuples."""
+        names = [name for name, _ in columns]
+        data = recfunctions.append_fields(self.data, names,
+                                          [np.asarray(col, dtype=float)
+                                           for _, col in columns],
+                                          dtypes=[float] * len(names),
+                                          usemask=False)
+        return self.__class__(data)
+
+    def bootstrap(self, nsamples=10000, cl=68.27, seed=None):
+        """Estimate the uncertainties of the rates with a Poisson bootstrap.
+
+        The raw and background counts of each bin are drawn from Poisson
+        distributions with the observed counts as the means, nsamples times,
+        and converted to raw, net, and background rates with the exposures of
+        the bin.
+
+        Resampling the counts of every pixel and summing them per bin (with
+        one (nsamples, pixels) array and a batched bincount) would need the
+        pixels of the region, which the table does not keep, and gigabytes of
+        memory for large regions. Instead, the bin totals are drawn directly.
+        A sum of independent Poisson variables is Poisson with the summed
+        mean, so the bin totals have the same distribution either way, and
+        only one (nsamples, bins) array is needed per type of counts.
+
+        Returns a copy of the table with the columns <rate>_err_lo and
+        <rate>_err_hi for the raw, net, and background rates, which hold the
+        distances from the measured rate to the lower and upper limits of the
+        central `cl` percent interval of the samples. Bins with no counts
+        have no exposure time equivalent (t_raw or t_bkg is NaN or 0); their
+        sampled rates are zero, like the measured ones, so they have zero
+        bootstrap uncertainties, which are then lower limits.
+        """
+        rng = np.random.default_rng(seed)
+        shape = (nsamples, len(self))
+        raw_cts = rng.poisson(self.data['raw_cts'], shape)
+        bkg_cts = rng.poisson(self.data['bkg_cts'], shape)
+        t_raw = self.data['t_raw']
+        t_bkg = self.data['t_bkg']
+        # Bins without counts always sample zero counts, and their exposure
+        # time equivalents are NaN (0 / 0) or 0.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            raw_rate = np.where(t_raw > 0, raw_cts / t_raw, 0.)
+            bkg_rate = np.where(t_bkg > 0, bkg_cts / t_bkg, 0.)
+        samples = {'raw_rate': raw_rate, 'net_rate': raw_rate - bkg_rate,
+                   'bkg_rate': bkg_rate}
+
+        lim_lower = 50. - cl / 2.
+        lim_upper = 50. + cl / 2.
+        columns = []
+        for name in BOOTSTRAP_RATES:
+            lower, upper = np.percentile(samples[name],
+                                         [lim_lower, lim_upper], axis=0)
+            columns.append((name + '_err_lo', self.data[name] - lower))
+            columns.append((name + '_err_hi', upper - self.data[name]))
+        return self.with_columns(columns)
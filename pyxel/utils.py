@@ -1,6 +1,13 @@
+from collections import namedtuple
+
 import numpy as np
 
 from .image import Image
+from .table import ProfileTable
+from .instrument import stage
+
+ObsData = namedtuple('ObsData', ['counts', 'bkg', 'exp',
+                                 'bkg_corr', 'exp_bkg_factor'])
 
 def rotate_point(x0, y0, x, y, angle):
     """Rotate point (x,y) counter-clockwise around (x0,y0)."""
@@ -20,10 +27,8 @@ def bin_pix2arcmin(bin_values, pix2arcmin):
         [i / pix2arcmin**2 for i in [raw_rate, net_rate, bkg_rate,
         err_raw_rate, err_net_rate, err_bkg_rate]]
     t_raw = raw_cts / raw_rate
-    if bkg_rate > 0:
-        t_bkg = bkg_cts / bkg_rate
-    else:
-        t_bkg = 0.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_bkg = np.where(bkg_rate > 0, bkg_cts / bkg_rate, 0.)[()]
     return (bin_radius, bin_width, raw_cts, net_cts,
             bkg_cts, raw_rate, err_raw_rate, net_rate, err_net_rate,
             bkg_rate, err_bkg_rate, t_raw, t_bkg)
@@ -82,6 +87,153 @@ def get_bkg_exp(counts_img, bkg_img, exp_img):
             raise TypeError('Unrecognized exposure image format.')
     return bkg_img, exp_img
 
+def get_cutout(img, bounds):
+    """Cut a map, or a list of maps, down to the section given by
+    bounds = (row_min, row_max, col_min, col_max)."""
+    row_min, row_max, col_min, col_max = bounds
+    if isinstance(img, Image):
+        return img.cutout(row_min, row_max, col_min, col_max)
+    elif isinstance(img, list):
+        return [get_cutout(i, bounds) for i in img]
+    elif isinstance(img, np.ndarray):
+        return img[row_min:row_max, col_min:col_max]
+    else:
+        return img
+
+def read_obs_data(counts_img, bkg_img, exp_img, bounds):
+    """Read the section of the source, background, and exposure maps given
+    by bounds = (row_min, row_max, col_min, col_max), and return it as
+    ObsData (see get_obs_data). Missing background or exposure maps are only
+    allocated for that section."""
+    with stage('read_obs_data'):
+        counts_img, bkg_img, exp_img = [get_cutout(img, bounds)
+                                        for img in (counts_img, bkg_img,
+                                                    exp_img)]
+        bkg_img, exp_img = get_bkg_exp(counts_img, bkg_img, exp_img)
+        return get_obs_data(counts_img, bkg_img, exp_img)
+
+def get_pix2arcmin(img):
+    """Return the pixel size of an image (or of the first image in a list)
+    in arcmin."""
+    if isinstance(img.hdr, list):
+        return img.hdr[0]['CDELT2'] * 60.
+    return img.hdr['CDELT2'] * 60.
+
+def get_exposure_time(hdr):
+    """Get the exposure time from an image header."""
+    if 'EXPOSURE' in hdr:
+        return hdr['EXPOSURE']
+    elif 'ONTIME' in hdr:
+        return hdr['ONTIME']
+    else:
+        raise KeyError('Image header has neither an EXPOSURE nor an ONTIME \
+            keyword.')
+
+def _to_obs_list(img, n_img, img_type):
+    """Return the data and headers of an image as lists with one entry per
+    observation."""
+    if isinstance(img, Image):
+        if not isinstance(img.data, list):
+            return [img.data] * n_img, [img.hdr] * n_img
+        elif len(img.data) != n_img:
+            raise ValueError('%s map must be either a single image, or a \
+                list of images with the same length as the list of source \
+                images.' % img_type)
+        else:
+            return img.data, img.hdr
+    elif isinstance(img, list):
+        return img, [None] * n_img
+    else:
+        return [img] * n_img, [None] * n_img
+
+def get_obs_data(counts_img, bkg_img, exp_img):
+    """Collect the maps and normalizations of each observation.
+
+    The background and exposure maps should be the ones returned by
+    get_bkg_exp. The exposure times and the BKGNORM keyword are read from the
+    headers only once. If the background map is not an Image, then it is
+    assumed to have the same exposure time as the source image, and no
+    background scaling is applied. Returns a list of ObsData tuples.
+    """
+    if isinstance(counts_img.data, list):
+        counts_data, counts_hdr = counts_img.data, counts_img.hdr
+    else:
+        counts_data, counts_hdr = [counts_img.data], [counts_img.hdr]
+    n_img = len(counts_data)
+    bkg_data, bkg_hdr = _to_obs_list(bkg_img, n_img, 'Background')
+    exp_data, _ = _to_obs_list(exp_img, n_img, 'Exposure')
+
+    obs_data = []
+    for i in range(n_img):
+        counts_img_exp = get_exposure_time(counts_hdr[i])
+        if bkg_hdr[i] is not None:
+            bkg_img_exp = get_exposure_time(bkg_hdr[i])
+            bkgnorm = bkg_hdr[i].get('BKGNORM', 1.)
+            bkg_corr = counts_img_exp * bkgnorm / bkg_img_exp
+        else:
+            bkg_img_exp = counts_img_exp
+            bkgnorm = 1.
+            bkg_corr = 1.
+        obs_data.append(ObsData(counts_data[i], bkg_data[i], exp_data[i],
+                                bkg_corr,
+                                bkg_img_exp / counts_img_exp / bkgnorm))
+    return obs_data
+
+def get_bin_sums(obs_data, rows, cols, labels, nbins):
+    """Sum the counts and exposures of the pixels in each bin.
+
+    `rows` and `cols` are the coordinates of the pixels, and `labels` the
+    index of the bin each pixel belongs to. Pixels with zero exposure are
+    ignored. The values of all observations are gathered into
+    (observation, pixel) arrays and reduced with a single bincount each.
+    Returns the raw, net, and background counts, and the source and
+    background exposures of each bin, as arrays of length nbins.
+    """
+    with stage('bin_sums', pixels=len(rows) * len(obs_data)):
+        return sum_pixel_values(get_pixel_values(obs_data, rows, cols),
+                                labels, nbins)
+
+def get_pixel_values(obs_data, rows, cols):
+    """Gather the values of the pixels at (rows, cols) from all observations.
+
+    Returns a tuple of (observation, pixel) arrays holding the raw, net, and
+    background counts, and the source and background exposures.
+    """
+    counts = np.array([obs.counts[rows, cols] for obs in obs_data],
+                      dtype=float)
+    bkg = np.array([obs.bkg[rows, cols] for obs in obs_data], dtype=float)
+    exp = np.array([obs.exp[rows, cols] for obs in obs_data], dtype=float)
+    bkg_corr = np.array([[obs.bkg_corr] for obs in obs_data])
+    exp_bkg_factor = np.array([[obs.exp_bkg_factor] for obs in obs_data])
+    return (counts, counts - bkg * bkg_corr, bkg, exp, exp * exp_bkg_factor)
+
+def sum_pixel_values(values, labels, nbins, pixels=None):
+    """Sum pixel values from get_pixel_values in bins.
+
+    If `pixels` is given, then only the values at these pixel indices are
+    summed, and `labels` holds their bins. Pixels with zero exposure are
+    ignored.
+    """
+    if pixels is not None:
+        values = [vals[:, pixels] for vals in values]
+    good = values[3] != 0
+    labels = np.broadcast_to(labels, good.shape)[good]
+    return tuple(np.bincount(labels, weights=vals[good], minlength=nbins)
+                 for vals in values)
+
+def get_bin_stats(raw_cts, net_cts, bkg_cts, exp_raw, exp_bkg):
+    """Calculate the rates and uncertainties in bins from the summed counts
+    and exposures returned by get_bin_sums."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw_rate = raw_cts / exp_raw
+        bkg_rate = bkg_cts / exp_bkg
+        net_rate = raw_rate - bkg_rate
+        err_raw_rate = np.sqrt(raw_cts) / exp_raw
+        err_bkg_rate = np.sqrt(bkg_cts) / exp_bkg
+        err_net_rate = np.sqrt(raw_cts / exp_raw**2 + bkg_cts / exp_bkg**2)
+    return raw_cts, net_cts, bkg_cts, \
+           raw_rate, err_raw_rate, net_rate, err_net_rate, bkg_rate, err_bkg_rate
+
 def merge_subpixel_bins(edges):
     new_edges = [edges[0]]
     start_edge = edges[0]
@@ -94,7 +246,7 @@ def merge_subpixel_bins(edges):
 
 def get_edges(max_r, islog):
     if not islog:
-        nbins = np.round(max_r)
+        nbins = int(np.round(max_r))
         # Below, nbins+1 is used because the code gets edges, not
         # bin centers. For nbins there will be nbins+1 edges
         return list(np.linspace(0., max_r, nbins + 1))
@@ -106,7 +258,7 @@ def get_edges(max_r, islog):
         # sub-pixel width, and then the merging will take care of them
         # later. The end result is a compromise between log-scaling and
         # getting one's time worth of bins.
-        nbins = 100.
+        nbins = 100
         min_r = 1.   # to avoid log(0)
         # Below, nbins+1 is used because the code gets edges, not
         # bin centers. For nbins there will be nbins+1 edges.
@@ -116,21 +268,16 @@ def get_edges(max_r, islog):
         return merge_subpixel_bins(edges)
 
 def get_data_for_chi(profile, minrange, maxrange):
-    nbins = len(profile)
-    r = np.array([profile[i][0] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    w = np.array([profile[i][1] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    net = np.array([profile[i][7] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    net_err = np.array([profile[i][8] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    return nbins, r, w, net, net_err
+    profile = ProfileTable.from_rows(profile)
+    selected = profile.select(minrange, maxrange)
+    return len(profile), selected['r'], selected['r_err'], \
+           selected['net_rate'], selected['net_rate_err']
 
 def get_data_for_cash(profile, minrange, maxrange):
-    nbins = len(profile)
-    r = np.array([profile[i][0] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    w = np.array([profile[i][1] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    raw_cts = np.array([profile[i][2] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    bkg = np.array([profile[i][5] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    sb_to_counts_factor = np.array([profile[i][9] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    return nbins, r, w, raw_cts, bkg, sb_to_counts_factor
+    profile = ProfileTable.from_rows(profile)
+    selected = profile.select(minrange, maxrange)
+    return len(profile), selected['r'], selected['r_err'], \
+           selected['raw_cts'], selected['raw_rate'], selected['bkg_rate']
 
 def call_model(func_name):
     model = getattr(model_defs, func_name)
@@ -7,12 +7,15 @@ setup(name='pyxel',
       author_email='georgiana.ogrean@gmail.com',
       url='https://github.com/gogrean/PyXel',
       packages=['pyxel'],
+      entry_points={
+          'console_scripts': ['pyxel-batch = pyxel.pipeline:main']
+      },
       install_requires=[
           'astropy>=1.1.2',
           'matplotlib>=1.5.1',
           'numpy>=1.11',
           'scipy>=0.17',
-          'emcee>=2.1',
+          'emcee>=3.0',
           'corner>=1.0.2',
           'tabulate>=0.7.5'
       ]
@@ -0,0 +1,116 @@
+import glob
+import os
+import shutil
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import pyxel
+from pyxel.cache import LabelCache, ProfileCache
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'examples', 'data')
+
+
+def test_label_cache_bounded_by_bytes():
+    # Each entry holds two int32 arrays, i.e. 8 bytes per pixel.
+    cache = LabelCache(max_bytes=8 * 250)
+    for key in range(3):
+        cache.put(key, np.arange(100), np.zeros(100))
+    assert cache.nbytes == 8 * 200
+    assert cache.get(0) is None
+    assert cache.get(1) is not None
+
+    # Key 2 is now the least recently used one.
+    cache.put(3, np.arange(100), np.zeros(100))
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+
+    # Entries larger than the whole cache are not kept.
+    cache.put(4, np.arange(300), np.zeros(300))
+    assert cache.get(4) is None
+    assert cache.nbytes == 8 * 200
+
+    cache.clear()
+    assert cache.nbytes == 0
+
+
+def test_label_cache_disabled():
+    cache = LabelCache(max_bytes=0)
+    cache.put('key', np.arange(10), np.zeros(10))
+    assert cache.get('key') is None
+
+
+@pytest.fixture
+def images():
+    def image(pattern):
+        return pyxel.Image(sorted(glob.glob(os.path.join(DATA_DIR,
+                                                         pattern))))
+    return (image('srcfree*_thresh.img'), image('*bgstow_goodreg.img'),
+            image('srcfree*expmap_nosrcedg'))
+
+
+def test_profile_cache_hit_and_invalidation(tmp_path, images):
+    cache = ProfileCache(str(tmp_path))
+    region = pyxel.load_region(os.path.join(DATA_DIR, 'ne.reg'))
+    counts, bkg, exp = images
+
+    expected = region.profile(counts, bkg, exp, 25, False, cache=False)
+    first = region.profile(counts, bkg, exp, 25, False, cache=cache)
+    second = region.profile(counts, bkg, exp, 25, False, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    np.testing.assert_array_equal(np.array(first), np.array(expected))
+    np.testing.assert_array_equal(np.array(second), np.array(expected))
+
+    # Other binning parameters are other entries.
+    region.profile(counts, bkg, exp, 50, False, cache=cache)
+    assert cache.misses == 2
+
+    # Modified images are not found in the cache.
+    counts.data[0][0, 0] += 1.
+    counts.reset_fingerprint()
+    region.profile(counts, bkg, exp, 25, False, cache=cache)
+    assert cache.misses == 3
+    counts.data = [data.copy() for data in counts.data]
+    region.profile(counts, bkg, exp, 25, False, cache=cache)
+    assert cache.hits == 2
+
+    exp.hdr[0]['EXPOSURE'] *= 2.
+    region.profile(counts, bkg, exp, 25, False, cache=cache)
+    assert cache.misses == 4
+
+
+def test_profile_cache_rewritten_file(tmp_path, images):
+    cache = ProfileCache(str(tmp_path / 'profiles'))
+    region = pyxel.load_region(os.path.join(DATA_DIR, 'ne.reg'))
+    _, bkg, exp = images
+    filenames = []
+    for filename in sorted(glob.glob(os.path.join(DATA_DIR,
+                                                  'srcfree*_thresh.img'))):
+        filenames.append(str(tmp_path / os.path.basename(filename)))
+        shutil.copy(filename, filenames[-1])
+    with pyxel.Image(filenames, memmap=True) as counts:
+        region.profile(counts, bkg, exp, 25, False, cache=cache)
+        region.profile(counts, bkg, exp, 25, False, cache=cache)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # A file is replaced during the session.
+        counts.close()
+        with fits.open(filenames[0]) as hdus:
+            data = hdus[0].data * 2
+            hdr = hdus[0].header
+        fits.writeto(filenames[0], data, hdr, overwrite=True)
+        os.utime(filenames[0], ns=(0, 0))
+        profile = region.profile(counts, bkg, exp, 25, False, cache=cache)
+        assert cache.misses == 2
+        expected = region.profile(counts, bkg, exp, 25, False)
+        np.testing.assert_array_equal(np.array(profile), np.array(expected))
+
+
+
+def test_profile_cache_eviction(tmp_path, images):
+    region = pyxel.load_region(os.path.join(DATA_DIR, 'ne.reg'))
+    cache = ProfileCache(str(tmp_path), max_bytes=1)
+    region.profile(*images, min_counts=25, islog=False, cache=cache)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from pyxel.fitters import CstatFitter, lnprob, lnprob_batch
+from pyxel.models import Beta, BrokenPow, IntModel
+from pyxel.optimizers import Minimize
+
+
+def beta_data(seed=0):
+    rng = np.random.RandomState(seed)
+    r = np.linspace(0.1, 3., 40)
+    r_err = np.full_like(r, (r[1] - r[0]) / 2)
+    t_raw = np.full_like(r, 1e5)
+    t_bkg = np.full_like(r, 1e6)
+    true = Beta(s0=1e-3, beta=0.7, rc=0.5, const=1e-5)
+    bkg_cts = rng.poisson(1e-5 * t_bkg).astype(float)
+    raw_cts = rng.poisson(true(r) * t_raw + 1e-5 * t_raw).astype(float)
+    return r, r_err, raw_cts, bkg_cts, t_raw, t_bkg
+
+
+def test_int_model_copies_constraints():
+    model = BrokenPow(ind1=0., ind2=1.2, norm=3.5e-5, rbreak=1.36, jump=2.5,
+                      const=5.45e-7)
+    model.const.fixed = True
+    model.jump.bounds = (1.5, 3.)
+    model.ind2.tied = lambda m: m.ind1 + 1.
+    int_model = IntModel(model, np.full(5, 0.05))
+    assert int_model.const.fixed
+    assert int_model.jump.bounds == (1.5, 3.)
+    assert int_model.ind2.tied is model.ind2.tied
+    assert not int_model.norm.fixed
+
+
+def test_fit_with_x_err_keeps_fixed_parameters():
+    r, r_err, raw_cts, bkg_cts, t_raw, t_bkg = beta_data()
+    model = Beta(s0=8e-4, beta=0.6, rc=0.4, const=1e-5)
+    model.const.fixed = True
+    fitted = CstatFitter()(model, r, raw_cts, bkg_cts, t_raw, t_bkg,
+                           x_err=r_err, maxiter=2000)
+    assert fitted.const.value == 1e-5
+    assert fitted.const.fixed
+
+
+def test_gradient_free_optimizer_skips_derivatives():
+    calls = []
+
+    class CountingBeta(Beta):
+        def evaluate_with_derivatives(self, *args):
+            calls.append(1)
+            return super(CountingBeta, self).evaluate_with_derivatives(*args)
+
+    r, r_err, raw_cts, bkg_cts, t_raw, t_bkg = beta_data()
+    model = CountingBeta(s0=8e-4, beta=0.6, rc=0.4, const=1e-5)
+    CstatFitter(Minimize('Nelder-Mead'))(model, r, raw_cts, bkg_cts,
+                                         t_raw, t_bkg, maxiter=200)
+    assert not calls
+    CstatFitter(Minimize('BFGS'))(model, r, raw_cts, bkg_cts, t_raw, t_bkg,
+                                  maxiter=20)
+    assert calls
+
+
+@pytest.mark.parametrize('integrate', [False, True])
+def test_lnprob_batch_matches_lnprob(integrate):
+    r, r_err, raw_cts, bkg_cts, t_raw, t_bkg = beta_data()
+    model = Beta(s0=1e-3, beta=0.7, rc=0.5, const=1e-5)
+    model.const.fixed = True
+    if integrate:
+        model = IntModel(model, r_err)
+    # Bounds of the free parameters (s0, beta, rc), NaN when unbounded.
+    bounds = (np.array([1e-12, 0.5, np.nan]), np.array([np.nan, 1., 2.]))
+    rng = np.random.RandomState(1)
+    mc_params = np.array([1e-3, 0.7, 0.5]) * \
+        (1. + 0.5 * rng.randn(50, 3))
+    mc_params[0, 1] = 0.4
+    mc_params[1, 2] = 2.5
+    data = (raw_cts, bkg_cts, t_raw, t_bkg, r)
+    lnp = lnprob_batch(mc_params, model.copy(), bounds, *data)
+    expected = [lnprob(params, model.copy(), bounds, *data)
+                for params in mc_params]
+    assert np.isneginf(lnp[:2]).all()
+    assert np.isfinite(lnp).sum() > 10
+    assert np.allclose(lnp, expected, rtol=1e-12, atol=0)
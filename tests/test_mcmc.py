@@ -0,0 +1,113 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+from pyxel.fitters import CstatFitter, fit_bounds
+from pyxel.mcmc import (ChainStore, chain_progress, progress_filename,
+                        read_chain)
+from pyxel.models import Beta, BrokenPow
+
+from test_fitters import beta_data
+
+
+def fill(store, nsteps, ndim=3, nwalkers=4):
+    for step in range(nsteps):
+        store.add(step, np.full((nwalkers, ndim), step + 1.))
+
+
+def test_chain_store_resume(tmp_path):
+    filename = str(tmp_path / 'chain.npy')
+    with ChainStore(filename, 10, 4, 3, thin=2) as store:
+        fill(store, 7)
+        assert store.nsaved == 3
+    assert read_chain(filename).shape == (3, 4, 3)
+
+    with ChainStore(filename, 10, 4, 3, thin=2, resume=True) as store:
+        assert store.steps_done == 6
+        np.testing.assert_array_equal(store.last_positions(), 6.)
+        for step in range(6, 10):
+            store.add(step, np.full((4, 3), step + 1.))
+    chain = read_chain(filename)
+    np.testing.assert_array_equal(chain[:, 0, 0], [2., 4., 6., 8., 10.])
+
+
+def test_chain_progress_fallback(tmp_path):
+    # Chains saved without a progress file are scanned for NaN.
+    filename = str(tmp_path / 'chain.npy')
+    with ChainStore(filename, 10, 4, 3) as store:
+        fill(store, 4)
+    os.remove(progress_filename(filename))
+    assert chain_progress(filename, np.load(filename, mmap_mode='r')) == \
+        (4, None)
+    assert len(read_chain(filename)) == 4
+
+
+def test_chain_store_resume_checks_thin(tmp_path):
+    filename = str(tmp_path / 'chain.npy')
+    with ChainStore(filename, 12, 4, 3, thin=2) as store:
+        fill(store, 4)
+    with pytest.raises(ValueError):
+        ChainStore(filename, 12, 4, 3, thin=1, resume=True)
+
+
+def run_mcmc(fitter, model, data, **kwargs):
+    r, _, raw_cts, bkg_cts, t_raw, t_bkg = data
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fitter.mcmc_err(model, r, raw_cts, bkg_cts, t_raw, t_bkg,
+                               nwalkers=16, with_corner=False, workers=1,
+                               **kwargs)
+
+
+def test_mcmc_err_chain_file(tmp_path):
+    np.random.seed(0)
+    data = beta_data()
+    model = Beta(s0=1e-3, beta=0.7, rc=0.5, const=1e-5)
+    fitter = CstatFitter()
+    filename = str(tmp_path / 'chain.npy')
+    with pytest.raises(ValueError):
+        run_mcmc(fitter, model, data, nruns=20, nburn=5, resume_chain=True)
+
+    run_mcmc(fitter, model, data, nruns=20, nburn=5, save_chain=True,
+             chain_filename=filename, adaptive=True, check_every=10)
+    assert fitter.mcmc_info['checkpoints']
+
+    # Reading the chain back replaces the diagnostics of the last run.
+    run_mcmc(fitter, model, data, nruns=20, nburn=5,
+             chain_filename=filename, clobber_chain=False)
+    assert fitter.mcmc_info == {'nsteps': 20, 'nburn': 5, 'converged': None,
+                                'checkpoints': []}
+
+    # The chain is complete, so resuming does not sample any more steps.
+    run_mcmc(fitter, model, data, nruns=20, nburn=5, save_chain=True,
+             chain_filename=filename, resume_chain=True)
+    assert fitter.mcmc_info['nsteps'] == 20
+    assert len(read_chain(filename)) == 20
+
+
+def test_fit_bounds():
+    model = Beta(s0=1e-3, beta=0.7, rc=0.5, const=1e-5)
+    model.beta.bounds = (0.5, 1.)
+    min_bounds, max_bounds = fit_bounds(model)
+    assert np.array_equal(min_bounds, [1e-12, 0.5, 1e-12, 1e-12])
+    assert np.array_equal(max_bounds, [np.nan, 1., np.nan, np.nan],
+                          equal_nan=True)
+    model.const.fixed = True
+    min_bounds, max_bounds = fit_bounds(model)
+    assert np.array_equal(min_bounds, [1e-12, 0.5, 1e-12])
+
+
+def test_mcmc_err_walkers_move(tmp_path):
+    np.random.seed(0)
+    data = beta_data()
+    model = BrokenPow(ind1=0., ind2=1.2, norm=1e-3, rbreak=1., jump=1.5,
+                      const=1e-5)
+    filename = str(tmp_path / 'chain.npy')
+    run_mcmc(CstatFitter(), model, data, nruns=10, nburn=0, save_chain=True,
+             chain_filename=filename)
+    chain = read_chain(filename)
+    # The walkers start spread around ind1 = 0, and are not all rejected.
+    assert np.all(np.ptp(chain[0], axis=0) > 0)
+    assert np.any(chain[-1] != chain[0])
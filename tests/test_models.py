@@ -0,0 +1,104 @@
+import pickle
+
+import numpy as np
+import pytest
+import scipy.integrate
+
+from pyxel.models import (Beta, BrokenPow, IntModel, projected_power_law,
+                          projected_power_law_deriv)
+
+RBREAK = 1.36
+INDICES = [-1., -0.3, 0., 0.3, 0.48, 0.4995, 0.5, 0.50005, 0.52, 0.7, 1.2,
+           3.5]
+RADII = [0., 0.01, 0.5, 1., 1.359, 2., 5.]
+
+
+def quad(func, x, z_min, z_max):
+    points = [p for p in (x, 1., 10., 100.) if z_min < p < z_max]
+    return scipy.integrate.quad(func, z_min, z_max, points=points or None,
+                                epsabs=0., epsrel=1e-12, limit=500)[0]
+
+
+def limits(x):
+    lim = np.sqrt(max(RBREAK**2 - x**2, 0.))
+    return [(1e-4, 1e4)] + ([(1e-4, lim), (lim, 1e4)] if lim > 1e-4 else [])
+
+
+@pytest.mark.parametrize('index', INDICES)
+def test_projected_power_law(index):
+    for x in RADII:
+        for z_min, z_max in limits(x):
+            expected = quad(lambda z: ((x**2 + z**2) / RBREAK**2)**(-index),
+                            x, z_min, z_max)
+            val = projected_power_law(x, z_min, z_max, index, RBREAK)
+            assert np.isfinite(val)
+            assert abs(val / expected - 1.) < 1e-7
+
+
+@pytest.mark.parametrize('index', INDICES)
+def test_projected_power_law_deriv(index):
+    # The documented tolerance, relative to the integral itself.
+    for x in RADII:
+        for z_min, z_max in limits(x):
+            s = lambda z: (x**2 + z**2) / RBREAK**2
+            value = quad(lambda z: s(z)**(-index), x, z_min, z_max)
+            expected = quad(lambda z: -np.log(s(z)) * s(z)**(-index),
+                            x, z_min, z_max)
+            deriv = projected_power_law_deriv(x, z_min, z_max, index, RBREAK)
+            assert abs(deriv - expected) < 1e-6 * value
+
+
+@pytest.mark.parametrize('ind1, ind2', [(0., 1.2), (-0.3, 1.12), (0.5, 2.)])
+def test_broken_pow_matches_quad(ind1, ind2):
+    x = np.array([0., 0.05, 0.5, 1.3, 1.4, 3.])
+    params = (ind1, ind2, 3.5e-5, 1.36, 2.5, 5.45e-7)
+    np.testing.assert_allclose(BrokenPow.evaluate(x, *params),
+                               BrokenPow.evaluate_quad(x, *params),
+                               rtol=1e-6)
+
+
+def int_model_loop(model, x, widths, order=5):
+    """Bin averages of a model, integrated bin by bin."""
+    roots, weights = np.polynomial.legendre.leggauss(order)
+    return np.array([np.sum(weights * model(xi + wi * roots)) / 2.
+                     for xi, wi in zip(x, widths)])
+
+
+def test_int_model_nodes():
+    x = np.linspace(0.1, 3., 30)
+    widths = np.full_like(x, 0.05)
+    model = Beta(s0=1e-3, beta=0.7, rc=0.5, const=1e-5)
+    int_model = IntModel(model, widths)
+    assert np.allclose(int_model(x), int_model_loop(model, x, widths),
+                       rtol=1e-12, atol=0)
+    # The node grid is reused for the same x, and rebuilt for a new one.
+    nodes = int_model.get_nodes(x)
+    assert int_model.get_nodes(x.copy()) is nodes
+    x2 = x + 0.01
+    assert int_model.get_nodes(x2) is not nodes
+    assert np.allclose(int_model(x2), int_model_loop(model, x2, widths),
+                       rtol=1e-12, atol=0)
+
+    # And it is rebuilt when the widths change, even in place.
+    int_model._widths = np.full_like(x, 0.2)
+    assert np.allclose(int_model(x2), int_model_loop(model, x2, np.full_like(x, 0.2)),
+                       rtol=1e-12, atol=0)
+    int_model._widths[:] = 0.1
+    assert np.allclose(int_model(x2), int_model_loop(model, x2, np.full_like(x, 0.1)),
+                       rtol=1e-12, atol=0)
+
+
+def test_int_model_pickle():
+    x = np.linspace(0.1, 3., 30)
+    model = BrokenPow(ind1=0.1, ind2=1.2, norm=3.5e-5, rbreak=1.36,
+                      jump=2.5, const=5.45e-7)
+    model.const.fixed = True
+    int_model = IntModel(model, np.full_like(x, 0.05))
+    vals = int_model(x)
+    copy = pickle.loads(pickle.dumps(int_model))
+    assert type(copy) is type(int_model)
+    # The node grid is not pickled, and is rebuilt when needed.
+    assert not hasattr(copy, '_nodes')
+    assert copy.const.fixed
+    assert np.array_equal(copy.parameters, int_model.parameters)
+    assert np.array_equal(copy(x), vals)
@@ -0,0 +1,98 @@
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+
+from pyxel import pipeline
+from pyxel.pipeline import (job_hash, load_result, open_images,
+                            read_manifest, run_pipeline)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'examples', 'data')
+
+
+def write_manifest(tmp_path, jobs):
+    def files(pattern):
+        return sorted(glob.glob(os.path.join(DATA_DIR, pattern)))
+    manifest = {
+        'images': {'zwcl2341': {
+            'counts': files('srcfree*_thresh.img'),
+            'bkg': files('*bgstow_goodreg.img'),
+            'exp': files('srcfree*expmap_nosrcedg')}},
+        'jobs': jobs}
+    filename = str(tmp_path / 'manifest.json')
+    with open(filename, 'w') as f:
+        json.dump(manifest, f)
+    return read_manifest(filename)
+
+
+def ne_job(**mcmc):
+    return {'name': 'ne', 'region': os.path.join(DATA_DIR, 'ne.reg'),
+            'images': 'zwcl2341', 'min_counts': 25, 'islog': False,
+            'fit': {'model': 'BrokenPow', 'rmin': 0.8, 'rmax': 2.5,
+                    'params': {'ind1': 0.1, 'ind2': 1.2, 'norm': 3.5e-5,
+                               'rbreak': 1.36, 'jump': 2.5,
+                               'const': 5.45e-7},
+                    'fixed': ['const'], 'integrate': True, 'maxiter': 50},
+            'mcmc': dict({'nruns': 4, 'nburn': 1, 'nwalkers': 12}, **mcmc)}
+
+
+def test_pipeline_reruns_modified_jobs(tmp_path):
+    sky_job = {'name': 'skybkg', 'images': 'zwcl2341',
+               'region': os.path.join(DATA_DIR, 'skybkg.reg')}
+    manifest = write_manifest(tmp_path, [ne_job(), sky_job])
+    table = run_pipeline(manifest, workers=1)
+    assert list(table['status']) == ['ok', 'ok']
+    # The fixed parameter stays fixed in the integrated model and in MCMC.
+    assert table['const'][0] == 5.45e-7
+    assert 'const_median' not in table.colnames
+    assert 'jump_median' in table.colnames
+
+    work_dir = manifest['work_dir']
+    hashes = {name: load_result(work_dir, name)['job_hash']
+              for name in ('ne', 'skybkg')}
+    mtimes = {name: os.path.getmtime(os.path.join(work_dir, name + '.json'))
+              for name in ('ne', 'skybkg')}
+
+    # Only the modified job runs again.
+    manifest = write_manifest(tmp_path, [ne_job(nruns=5), sky_job])
+    run_pipeline(manifest, workers=1)
+    assert load_result(work_dir, 'ne')['job_hash'] != hashes['ne']
+    assert load_result(work_dir, 'skybkg')['job_hash'] == hashes['skybkg']
+    assert os.path.getmtime(os.path.join(work_dir, 'skybkg.json')) == \
+        mtimes['skybkg']
+    assert np.isfinite(load_result(work_dir, 'ne')['jump_median'])
+
+
+def test_job_hash_follows_image_files(tmp_path):
+    filenames = []
+    for filename in sorted(glob.glob(os.path.join(DATA_DIR,
+                                                  'srcfree*_thresh.img'))):
+        filenames.append(str(tmp_path / os.path.basename(filename)))
+        shutil.copy(filename, filenames[-1])
+    job = {'name': 'ne', 'region': os.path.join(DATA_DIR, 'ne.reg'),
+           'images': 'zwcl2341'}
+    image_set = {'counts': filenames}
+    digest = job_hash(job, image_set)
+    assert job_hash(job, image_set) == digest
+    # Reprocessed images with the same file names.
+    shutil.copy(filenames[1], filenames[0])
+    assert job_hash(job, image_set) != digest
+
+
+def test_open_images_shares_files(monkeypatch):
+    monkeypatch.setattr(pipeline, '_open_files', {})
+    counts = sorted(glob.glob(os.path.join(DATA_DIR, 'srcfree*_thresh.img')))
+    exp = sorted(glob.glob(os.path.join(DATA_DIR, 'srcfree*expmap_nosrcedg')))
+    imgs1 = open_images({'counts': counts[:3], 'exp': exp[:3]})
+    imgs2 = open_images({'counts': counts[2:], 'exp': exp[2:]})
+    assert len(pipeline._open_files) == 10
+    # The ObsID shared by the two sets is opened once.
+    assert imgs1['counts'].data[2] is imgs2['counts'].data[0]
+    assert imgs1['counts'].hdr[2] is imgs2['counts'].hdr[0]
+    assert imgs2['bkg'] is None
+    assert imgs1['counts'].filename == counts[:3]
+    for img in pipeline._open_files.values():
+        img.close()
@@ -0,0 +1,83 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import pyxel
+from pyxel.prof import group_regions
+from pyxel.utils import get_bkg_exp, get_obs_data
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'examples', 'data')
+
+
+@pytest.fixture(scope='module')
+def images():
+    def image(pattern):
+        return pyxel.Image(sorted(glob.glob(os.path.join(DATA_DIR,
+                                                         pattern))))
+    return (image('srcfree*_thresh.img'), image('*bgstow_goodreg.img'),
+            image('srcfree*expmap_nosrcedg'))
+
+
+def test_group_regions():
+    bounds = [(0, 100, 0, 100), (10, 50, 10, 50), (900, 950, 900, 950),
+              (60, 110, 60, 110)]
+    groups = group_regions(bounds)
+    assert groups == [((0, 110, 0, 110), [0, 1, 3]),
+                      ((900, 950, 900, 950), [2])]
+
+
+def test_profiles_match_single_regions(images):
+    regions = [pyxel.load_region(os.path.join(DATA_DIR, name))
+               for name in ('ne.reg', 'skybkg.reg')]
+    tables = pyxel.profiles(regions, *images, min_counts=25, islog=False)
+    for region, table in zip(regions, tables):
+        expected = region.profile(*images, min_counts=25, islog=False)
+        np.testing.assert_allclose(np.array(table), np.array(expected),
+                                   rtol=1e-12)
+
+
+def bins_vals_loop(region, images, pixels_in_bins):
+    """The values of get_bins_vals, computed bin by bin with get_bin_vals,
+    and the exposures summed pixel by pixel."""
+    counts, bkg, exp = images
+    bkg, exp = get_bkg_exp(counts, bkg, exp)
+    obs_data = get_obs_data(counts, bkg, exp)
+    vals = []
+    for pixels in pixels_in_bins:
+        exp_raw = exp_bkg = 0.
+        for row, col in pixels:
+            for obs in obs_data:
+                pixel_exp = float(obs.exp[row, col])
+                if pixel_exp != 0:
+                    exp_raw += pixel_exp
+                    exp_bkg += pixel_exp * obs.exp_bkg_factor
+        vals.append(region.get_bin_vals(counts, bkg, exp, pixels) +
+                    (exp_raw, exp_bkg))
+    return [np.array(val) for val in zip(*vals)]
+
+
+@pytest.mark.parametrize('reg_name', ['ne', 'skybkg'])
+@pytest.mark.parametrize('gaps', [False, True])
+def test_get_bins_vals_matches_get_bin_vals(images, reg_name, gaps):
+    region = pyxel.load_region(os.path.join(DATA_DIR, reg_name + '.reg'))
+    bins = region.merge_bins(*images, min_counts=25, islog=False)
+    pixels_in_bins = [pixels for _, _, pixels in bins]
+    if gaps:
+        # Every other bin is empty (except the last one, which sets the
+        # number of bins), and the others have holes.
+        last = len(pixels_in_bins) - 1
+        pixels_in_bins = [pixels[::2] if i % 2 == 0 or i == last else []
+                          for i, pixels in enumerate(pixels_in_bins)]
+    label_map = np.full(images[0].shape, -1)
+    for i, pixels in enumerate(pixels_in_bins):
+        for row, col in pixels:
+            label_map[row, col] = i
+    vals = region.get_bins_vals(*images, label_map)
+    expected = bins_vals_loop(region, images, pixels_in_bins)
+    assert len(vals) == 11
+    for val, expected_val in zip(vals, expected):
+        assert len(val) == len(pixels_in_bins)
+        np.testing.assert_allclose(val, expected_val, rtol=1e-10)
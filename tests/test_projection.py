@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from pyxel import projection
+from pyxel.models import BrokenPow, LOS_Z_MAX, LOS_Z_MIN, TABLE_MIN_POINTS
+
+GRIDS = dict(log_u_grid=(-3., 0., 13), inner_index_grid=(-1., 3., 9),
+             outer_limit_grid=(0., 1., 11), outer_index_grid=(0.55, 3., 8))
+
+
+@pytest.fixture(scope='module')
+def table(tmp_path_factory):
+    table = projection.enable_projection_table(
+        str(tmp_path_factory.mktemp('tables')), workers=1, **GRIDS)
+    projection.disable_projection_table()
+    return table
+
+
+@pytest.mark.parametrize('index', [-1., -0.3, 0.55, 1.234, 3.])
+def test_index_slice_matches_spline(table, index):
+    log_u = np.linspace(-3., 0., 37)
+    for spline in (table._inner, table._inner_deriv):
+        sliced = projection._IndexSlice(spline)(log_u, index)
+        np.testing.assert_allclose(
+            sliced, spline.ev(log_u, np.full_like(log_u, index)),
+            rtol=1e-12, atol=1e-12)
+
+
+def test_integrals_without_derivatives(table):
+    x = np.logspace(-1, 0.7, 50)
+    with_derivs = table.integrals(x, 1.36, 0.3, 1.2, LOS_Z_MIN, LOS_Z_MAX)
+    tmp1, tmp2, d_tmp1, d_tmp2 = table.integrals(
+        x, 1.36, 0.3, 1.2, LOS_Z_MIN, LOS_Z_MAX, with_derivs=False)
+    assert d_tmp1 is None and d_tmp2 is None
+    np.testing.assert_array_equal(tmp1, with_derivs[0])
+    np.testing.assert_array_equal(tmp2, with_derivs[1])
+
+
+def test_small_arrays_use_closed_form(table):
+    x = np.logspace(-1, 0.7, TABLE_MIN_POINTS - 1)
+    params = (0.3, 1.2, 3.5e-5, 1.36, 2.5, 5.45e-7)
+    closed = BrokenPow.evaluate(x, *params)
+    projection.set_projection_table(table)
+    try:
+        np.testing.assert_array_equal(BrokenPow.evaluate(x, *params), closed)
+        x = np.logspace(-1, 0.7, TABLE_MIN_POINTS)
+        np.testing.assert_allclose(BrokenPow.evaluate(x, *params),
+                                   BrokenPow.evaluate_quad(x, *params),
+                                   rtol=10 * table.error_bound)
+    finally:
+        projection.set_projection_table(None)
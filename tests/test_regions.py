@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from matplotlib.path import Path
+
+from pyxel.box import Box
+from pyxel.epanda import Epanda
+from pyxel.utils import get_edges, rotate_point
+
+
+def epanda_pixels_loop(reg, edges, length, width):
+    """Pixel assignment of Epanda.distribute_pixels before vectorization."""
+    pixels = []
+    x_min_bound = int(np.floor(reg.x0 - reg.major_axis))
+    x_max_bound = int(np.floor(reg.x0 + reg.major_axis))
+    y_min_bound = int(np.ceil(reg.y0 - reg.major_axis))
+    y_max_bound = int(np.ceil(reg.y0 + reg.major_axis))
+    for x in range(max(0, x_min_bound), min(x_max_bound+1, width)):
+        for y in range(max(0, y_min_bound), min(y_max_bound+1, length)):
+            x_rot_back, y_rot_back = rotate_point(reg.x0, reg.y0,
+                                                  x - reg.x0, y - reg.y0,
+                                                  -reg.rot_angle)
+            if x_rot_back - reg.x0 >= 0:
+                r = np.sqrt((x_rot_back - reg.x0)**2 +
+                            (y_rot_back - reg.y0)**2)
+                if r < 1e-10:
+                    xy_angle = reg.start_angle
+                else:
+                    xy_angle = np.arcsin((y_rot_back - reg.y0) / r)
+                if xy_angle < 0:
+                    xy_angle = 2 * np.pi + xy_angle
+            else:
+                xy_angle = np.arctan((y_rot_back - reg.y0) /
+                                     (x_rot_back - reg.x0)) + np.pi
+            if reg.start_angle <= xy_angle <= reg.end_angle:
+                outer_ellipse_eq = [(x_rot_back - reg.x0)**2 / edges[i]**2 +
+                                    (y_rot_back - reg.y0)**2 / edges[i]**2 *
+                                    reg.major_axis**2 / reg.minor_axis**2
+                                    for i in range(1, len(edges))]
+                for i, eq in enumerate(outer_ellipse_eq[1:]):
+                    if eq < 1:
+                        pixels.append((y, x, i))
+                        break
+    return pixels
+
+
+def box_pixels_loop(reg, edges, length, width):
+    """Pixel assignment of Box.distribute_pixels before vectorization."""
+    reg_path = Path(reg.get_corners())
+    [[x_min_bound, y_min_bound], [x_max_bound, y_max_bound]] = \
+        reg_path.get_extents().get_points()
+    x_min_bound = int(np.floor(x_min_bound))
+    y_min_bound = int(np.floor(y_min_bound))
+    x_max_bound = int(np.ceil(x_max_bound))
+    y_max_bound = int(np.ceil(y_max_bound))
+    pixels = []
+    for x in range(max(0, x_min_bound), min(x_max_bound+1, width)):
+        for y in range(max(0, y_min_bound), min(y_max_bound+1, length)):
+            if reg_path.contains_point((x, y)):
+                x_nonrotated, y_nonrotated = rotate_point(reg.x0, reg.y0,
+                                                          x - reg.x0,
+                                                          y - reg.y0,
+                                                          -reg.angle)
+                dist_from_box_bottom = reg.height/2. - \
+                                       (reg.y0 - y_nonrotated)
+                for i, edge in enumerate(edges[1:]):
+                    if edge > dist_from_box_bottom:
+                        pixels.append((y, x, i))
+                        break
+    return pixels
+
+
+@pytest.mark.parametrize('params', [
+    (50., 40., 0., 2 * np.pi, 20., 20., 0.),
+    (50.3, 40.7, 0.3, 2.1, 30., 18., 0.6),
+    (10.5, 85.2, 4., 6., 25., 12., 2.2),
+    (95., 5., 1., 5.5, 40., 35., 1.1),
+])
+@pytest.mark.parametrize('islog', [False, True])
+def test_epanda_distribute_pixels_matches_loop(params, islog):
+    reg = Epanda(*params)
+    edges = get_edges(reg.major_axis, islog)
+    length, width = 90, 100
+    pixels = reg.distribute_pixels(edges, length, width)
+    expected = epanda_pixels_loop(reg, edges, length, width)
+    assert len(pixels) == len(set(pixels))
+    assert set(pixels) == set(expected)
+
+
+@pytest.mark.parametrize('params', [
+    # Sides through pixel centers, where the pixels on the sides are kept
+    # or dropped depending on the orientation of the box.
+    (50., 40., 20., 30., 0.),
+    (50., 40., 20., 30., np.pi / 2),
+    (50., 40., 20., 30., np.pi),
+    (50., 40., 20., 30., 3 * np.pi / 2),
+    (50.5, 40.5, 21., 31., np.pi / 2),
+    (50., 40.5, 20., 30., np.pi),
+    (50.3, 40.2, 20.5, 30.5, 0.),
+    (50.3, 40.7, 30.1, 18.3, 0.6),
+    (10.5, 85.2, 25.3, 40.1, 2.2),
+    (95.1, 5.4, 40.3, 35.7, -1.1),
+])
+@pytest.mark.parametrize('islog', [False, True])
+def test_box_distribute_pixels_matches_loop(params, islog):
+    reg = Box(*params)
+    edges = reg.make_edges(islog)
+    length, width = 90, 100
+    pixels = reg.distribute_pixels(edges, length, width)
+    expected = box_pixels_loop(reg, edges, length, width)
+    assert len(pixels) == len(set(pixels))
+    assert set(pixels) == set(expected)
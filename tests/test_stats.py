@@ -0,0 +1,105 @@
+import numpy as np
+
+from pyxel.models import Beta
+from pyxel.stats import cstat, cstat_deriv
+
+
+def cstat_loop(raw_cts, model, bkg_cts, t_raw, t_bkg, x):
+    """C-statistic as computed bin by bin before vectorization."""
+    model_vals = model(x)
+    tmp1 = t_raw + t_bkg
+    tmp2 = tmp1 * model_vals
+    tmp3 = tmp2 - raw_cts - bkg_cts
+    tmp4 = tmp2 * bkg_cts
+    tmp5 = t_raw * model_vals
+    tmp6 = t_bkg * model_vals
+    d = (tmp3 ** 2 + 4. * tmp4)**0.5
+    f = (-tmp3 + d) / (2. * tmp1)
+    cash = 0.
+    for i in range(len(model_vals)):
+        if raw_cts[i] == 0 and bkg_cts[i] > 0:
+            cash += tmp5[i] - bkg_cts[i] * np.log(t_bkg[i] / tmp1[i])
+        elif bkg_cts[i] == 0 and raw_cts[i] > 0:
+            if tmp2[i] < raw_cts[i]:
+                cash -= tmp6[i] + raw_cts[i] * np.log(t_raw[i] / tmp1[i])
+            else:
+                cash += tmp5[i] + raw_cts[i] * \
+                        (np.log(raw_cts[i]/tmp5[i]) - 1)
+        else:
+            cash += tmp5[i] + tmp1[i] * f[i] - \
+                    raw_cts[i] * np.log(t_raw[i] * (model_vals[i] + f[i])) \
+                    - bkg_cts[i] * np.log(t_bkg[i] * f[i]) - \
+                    raw_cts[i] * (1 - np.log(raw_cts[i])) - \
+                    bkg_cts[i] * (1 - np.log(bkg_cts[i]))
+    return 2. * cash
+
+
+def cstat_deriv_loop(raw_cts, model, bkg_cts, t_raw, t_bkg, x):
+    """Derivatives of the C-statistic as computed bin by bin before
+    vectorization."""
+    model_derivs = np.array(model.fit_deriv(x, *model.parameters))
+    model_vals = model(x)
+    d_cash = np.zeros(len(model.parameters))
+    tmp1 = t_raw + t_bkg
+    tmp2 = tmp1 * model_vals
+    tmp3 = tmp2 - raw_cts - bkg_cts
+    tmp4 = tmp2 * bkg_cts
+    tmp5 = tmp1 * model_derivs
+    tmp6 = tmp5 * bkg_cts
+    tmp7 = t_raw * model_derivs
+    tmp8 = t_bkg * model_derivs
+    d = (tmp3 ** 2 + 4. * tmp4)**0.5
+    f = (-tmp3 + d) / (2. * tmp1)
+    d_d = (tmp3 ** 2 + 4. * tmp4)**-0.5 * (2. * tmp6 + tmp3 * tmp5)
+    d_f = -0.5 * model_derivs + d_d / (2. * tmp1)
+    for i in range(len(model_vals)):
+        if raw_cts[i] == 0 and bkg_cts[i] > 0:
+            d_cash += tmp7[:, i]
+        elif bkg_cts[i] == 0 and raw_cts[i] > 0:
+            if tmp2[i] < raw_cts[i]:
+                d_cash -= tmp8[:, i]
+            else:
+                d_cash += tmp7[:, i] - \
+                          raw_cts[i] * 1. / model_vals[i] * model_derivs[:, i]
+        else:
+            d_cash += tmp7[:, i] + tmp1[i] * d_f[:, i] - \
+                      raw_cts[i] * 1. / (model_vals[i] + f[i]) * \
+                      (model_derivs[:, i] + d_f[:, i]) - \
+                      bkg_cts[i] * 1. / f[i] * d_f[:, i]
+    return 2. * d_cash
+
+
+def stat_data(seed=0):
+    """Counts with bins of each case: no source counts, no background
+    counts (with the model above and below the counts), and both."""
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0.1, 3., 40)
+    model = Beta(s0=1e-2, beta=0.7, rc=0.5, const=1e-4)
+    t_raw = rng.uniform(500., 1500., x.size)
+    t_bkg = rng.uniform(2000., 6000., x.size)
+    raw_cts = rng.poisson(model(x) * t_raw * 1.5).astype(float)
+    bkg_cts = rng.poisson(1e-4 * t_bkg).astype(float) + 1.
+    raw_cts[::5] = 0.
+    bkg_cts[1::5] = 0.
+    raw_cts[1::10] = np.maximum(raw_cts[1::10], 1.)
+    raw_cts[6::10] = 1.
+    return raw_cts, model, bkg_cts, t_raw, t_bkg, x
+
+
+def test_cstat_matches_loop():
+    args = stat_data()
+    raw_cts, model, bkg_cts, t_raw, t_bkg, x = args
+    tmp2 = (t_raw + t_bkg) * model(x)
+    no_bkg = (bkg_cts == 0) & (raw_cts > 0)
+    # All the cases are covered.
+    assert np.any((raw_cts == 0) & (bkg_cts > 0))
+    assert np.any(no_bkg & (tmp2 < raw_cts))
+    assert np.any(no_bkg & (tmp2 >= raw_cts))
+    assert np.any((raw_cts > 0) & (bkg_cts > 0))
+    assert np.isclose(cstat(*args), cstat_loop(*args), rtol=1e-12)
+
+
+def test_cstat_deriv_matches_loop():
+    args = stat_data(1)
+    assert np.allclose(cstat_deriv(*args), cstat_deriv_loop(*args),
+                       rtol=1e-10, atol=0)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from pyxel.table import ProfileTable
+from pyxel.utils import bin_pix2arcmin, get_bin_stats
+
+
+def test_bootstrap_zero_count_bins():
+    raw_cts = np.array([0., 4., 100.])
+    bkg_cts = np.array([0., 1., 10.])
+    stats = get_bin_stats(raw_cts, raw_cts - bkg_cts, bkg_cts,
+                          np.full(3, 5.), np.full(3, 50.))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        columns = bin_pix2arcmin((np.arange(3.), np.full(3, 0.5)) + stats,
+                                 0.03)
+    table = ProfileTable.from_columns(columns)
+    assert np.isnan(table['t_raw'][0])
+
+    boot = table.bootstrap(nsamples=2000, seed=1)
+    for name in ('raw_rate', 'net_rate', 'bkg_rate'):
+        lo = boot[name + '_err_lo']
+        hi = boot[name + '_err_hi']
+        assert np.all(np.isfinite(lo)) and np.all(np.isfinite(hi))
+        assert lo[0] == 0. and hi[0] == 0.
+        assert hi[2] > 0.
+    # For many counts, the errors are close to the Gaussian ones.
+    np.testing.assert_allclose(boot['raw_rate_err_hi'][2],
+                               table['raw_rate_err'][2], rtol=0.15)